@@ -0,0 +1,257 @@
+"""
+Benchmark the scoring service in-process and print the results as JSON.
+Only the results go to stdout; progress and app log messages go to stderr.
+
+The Flask app is loaded with the blob service client replaced by a local
+stub, so no storage module is needed.  Two kinds of measurement are made:
+
+* load: POST /score from several threads at a time and report throughput
+  and p50/p95/p99 latency for each concurrency level and frame source
+* stages: time Preprocess, invoke, filter_boxes/NMS, draw_bbox and JPEG
+  encoding separately on the same frame
+
+Usage (from this directory, with the model next to the app as usual):
+    python benchmark.py --concurrency 1,4,8 --requests 200 --output bench.json
+
+Environment variables used by the app (BATCH_MAX_SIZE, POSTPROCESS, ...)
+apply here too, so configurations can be compared run by run.
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGE = os.path.join(APP_DIR, '..', '..', 'assets', 'giraffe.jpg')
+
+
+class _StubContainerClient:
+    """Stands in for a blob container client; uploads are only counted"""
+    def __init__(self, service):
+        self._service = service
+
+    def create_container(self):
+        pass
+
+    def upload_blob(self, name, data, metadata=None, **kwargs):
+        with self._service.lock:
+            self._service.uploaded += 1
+            self._service.uploaded_bytes += len(data)
+
+
+class _StubBlobServiceClient:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+
+    def get_container_client(self, container_name):
+        return _StubContainerClient(self)
+
+
+def load_app():
+    """Import the app module with the blob service client stubbed out"""
+    from azure.storage.blob import BlobServiceClient
+    BlobServiceClient.from_connection_string = classmethod(
+        lambda cls, *args, **kwargs: _StubBlobServiceClient())
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    spec = importlib.util.spec_from_file_location(
+        'yolov4_tf_tiny_app', os.path.join(APP_DIR, 'yolov4-tf-tiny-app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    if len(samples) == 0:
+        return {}
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {'mean_ms': round(float(samples.mean()), 3),
+            'p50_ms': round(float(p50), 3),
+            'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3),
+            'max_ms': round(float(samples.max()), 3)}
+
+
+def frame_sources(image_path, synthetic_sizes):
+    """Request bodies to drive /score with: (name, body, query string)"""
+    sources = []
+    if image_path:
+        with open(image_path, 'rb') as f:
+            sources.append((os.path.basename(image_path), f.read(), ''))
+    rng = np.random.RandomState(0)
+    for size in synthetic_sizes:
+        width, height = [int(v) for v in size.lower().split('x')]
+        frame = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+        # Smooth the noise a little so JPEG sizes resemble camera frames
+        frame = cv2.GaussianBlur(frame, (9, 9), 0)
+        ok, encoded = cv2.imencode('.jpg', frame)
+        sources.append(('synthetic-{}-jpeg'.format(size), encoded.tobytes(), ''))
+        sources.append(('synthetic-{}-bgr24'.format(size), frame.tobytes(),
+                        '?pixel_format=bgr24&width={}&height={}'.format(width, height)))
+    return sources
+
+
+def run_load(app, body, query, concurrency, requests, warmup):
+    """POST body to /score from concurrency threads, requests in total"""
+    client = app.test_client()
+    for _ in range(warmup):
+        client.post('/score' + query, data=body)
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            response = client.post('/score' + query, data=body)
+            elapsed = (time.perf_counter() - start) * 1000.
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {'concurrency': concurrency,
+              'requests': requests,
+              'elapsed_s': round(elapsed, 3),
+              'throughput_rps': round(requests / elapsed, 2),
+              'status_codes': {str(code): count for code, count in sorted(statuses.items())}}
+    result.update(percentiles(latencies))
+    return result
+
+
+def time_stage(func, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.)
+    return percentiles(samples)
+
+
+def run_stages(module, cvImage, iterations):
+    """Time each step of Score on one frame"""
+    import core.utils as utils
+    import core.encoding as encoding
+    yolo, FLAGS = module.yolo, module.FLAGS
+    stages = {}
+    with yolo.registry.active() as model:
+        input_size = model.input_size
+        preprocess = yolo.PreprocessFrame if yolo._takes_frames(model.pool) else yolo.Preprocess
+        stages['preprocess'] = time_stage(
+            lambda: preprocess(cvImage, input_size=input_size), iterations)
+        image_data = preprocess(cvImage, input_size=input_size)
+        with model.pool.checkout() as runner:
+            stages['invoke'] = time_stage(
+                lambda: yolo._invoke(runner, [image_data]), iterations)
+            pred = yolo._invoke(runner, [image_data])
+        labels = model.labels
+    stages['filter_boxes_nms'] = time_stage(lambda: yolo._nms(pred, input_size), iterations)
+    pred_bbox = list(yolo._nms(pred, input_size))
+    stages['draw_bbox'] = time_stage(
+        lambda: utils.draw_bbox(cvImage.copy(), pred_bbox, labels, bgr=True), iterations)
+    for encoder in ('cv2', 'pil'):
+        stages['jpeg_encode_' + encoder] = time_stage(
+            lambda: encoding.render_jpeg(cvImage, encoder=encoder,
+                                         quality=FLAGS.jpeg_quality,
+                                         max_width=FLAGS.jpeg_max_width), iterations)
+    return stages
+
+
+def run_benchmark(args):
+    """Load the app, run the load and stage measurements and return the results"""
+    module = load_app()
+    sources = frame_sources(args.image, [s for s in args.synthetic.split(',') if s])
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+
+    results = {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'model_version': module.yolo.registry.active_version},
+        'config': {key: module.FLAGS[key] for key in sorted(module.FLAGS)
+                   if key not in ('output',)},
+        'startup': module.yolo.startup_times,
+        'load': [],
+        'stages': {}}
+
+    for name, body, query in sources:
+        for concurrency in levels:
+            result = run_load(module.app, body, query, concurrency, args.requests, args.warmup)
+            result['source'] = name
+            result['body_bytes'] = len(body)
+            results['load'].append(result)
+            print({'[INFO]': '{} x{}: {} req/s, p50 {} ms, p99 {} ms'.format(
+                name, concurrency, result['throughput_rps'],
+                result.get('p50_ms'), result.get('p99_ms'))}, file=sys.stderr)
+
+    if args.stage_iterations > 0 and args.image:
+        cvImage = cv2.imread(args.image)
+        results['stages'] = run_stages(module, cvImage, args.stage_iterations)
+
+    # Let queued uploads finish so the counters are complete
+    deadline = time.time() + 10
+    while module.yolo.uploader.stats()['queue_depth'] and time.time() < deadline:
+        time.sleep(0.05)
+    results['uploads'] = module.yolo.uploader.stats()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the YOLO v4 scoring service')
+    parser.add_argument('--image', default=DEFAULT_IMAGE,
+                        help='Sample image to post (empty to skip)')
+    parser.add_argument('--synthetic', default='1280x720',
+                        help='Comma-separated WxH sizes of synthetic frames (empty to skip)')
+    parser.add_argument('--concurrency', default='1,4',
+                        help='Comma-separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='Requests per concurrency level and frame source')
+    parser.add_argument('--warmup', type=int, default=5, help='Requests before measuring')
+    parser.add_argument('--stage-iterations', type=int, default=50,
+                        help='Iterations per stage microbenchmark (0 to skip)')
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    # The app logs to stdout; send everything but the results to stderr so
+    # that stdout can be redirected to a JSON file
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_benchmark(args)
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        print(output, file=stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Latency-SLO controller that trades model input resolution for latency.
+
+The controller keeps a base input size, starting with the largest, and a
+window of recent scoring latencies.  Once the window's p95 passes the
+target it steps down to the next smaller size; it steps back up when the
+p95 scaled by the pixel count of the larger size would still meet the
+target.  On top of that, each frame drops one more size for every
+queue_depth frames already being scored, so bursts degrade resolution
+straight away instead of queueing.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+import numpy as np
+
+import core.metrics as metrics
+
+
+class ResolutionController:
+    """Pick an input size from sizes per frame to keep the p95 scoring
+    latency under target_ms"""
+    def __init__(self, sizes, target_ms, queue_depth=1, window=100, min_samples=20):
+        self.sizes = sorted(set(int(s) for s in sizes), reverse=True)
+        if not self.sizes:
+            raise ValueError('ResolutionController needs at least one input size')
+        self.target = float(target_ms) / 1000.
+        self.queue_depth = max(1, int(queue_depth))
+        self.min_samples = max(1, int(min_samples))
+        self.level = 0
+        self._latencies = collections.deque(maxlen=max(int(window), self.min_samples))
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._counts = collections.OrderedDict((size, 0) for size in self.sizes)
+
+    @contextlib.contextmanager
+    def choose(self):
+        """Input size for the frame scored in the with-block, whose
+        duration is recorded as its latency.  A block that raises is not
+        recorded or counted, as the frame was not scored."""
+        with self._lock:
+            self._in_flight += 1
+            level = min(self.level + (self._in_flight - 1) // self.queue_depth,
+                        len(self.sizes) - 1)
+            size = self.sizes[level]
+        start = time.perf_counter()
+        try:
+            yield size
+        except BaseException:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        self._record(size, time.perf_counter() - start)
+
+    def _record(self, size, seconds):
+        metrics.INPUT_SIZE_FRAMES.labels(str(size)).inc()
+        with self._lock:
+            self._in_flight -= 1
+            self._counts[size] += 1
+            self._latencies.append(seconds)
+            if len(self._latencies) < self.min_samples:
+                return
+            p95 = float(np.percentile(self._latencies, 95))
+            if p95 > self.target and self.level < len(self.sizes) - 1:
+                self.level += 1
+            elif self.level > 0 and \
+                    p95 * (self.sizes[self.level - 1] / float(self.sizes[self.level])) ** 2 \
+                    < self.target:
+                self.level -= 1
+            else:
+                return
+            # Judge the new size on its own latencies
+            self._latencies.clear()
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            return {'size': self.sizes[self.level],
+                    'target_ms': self.target * 1000.,
+                    'p95_ms': round(float(np.percentile(latencies, 95)) * 1000., 2)
+                    if latencies else None,
+                    'in_flight': self._in_flight,
+                    'frames_by_size': {str(k): v for k, v in self._counts.items()}}
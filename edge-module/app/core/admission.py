@@ -0,0 +1,95 @@
+"""
+Admission control and deadline-aware load shedding for scoring requests.
+
+At most max_in_flight frames are scored at once and at most max_queue wait
+for a turn, in arrival order; any further request is rejected straight
+away.  A frame whose deadline passes while it waits is dropped before it
+reaches inference, as nobody is waiting for its result any more.
+"""
+import collections
+import contextlib
+import threading
+import time
+
+
+class Rejected(Exception):
+    """The frame was not scored: the queue is full or its deadline passed.
+    reason is 'rejected' or 'expired'."""
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def request_start(header, now=None):
+    """Arrival time on the time.time() clock from an X-Request-Start header
+    as nginx sets it ("t=<seconds>" with millisecond decimals), else now"""
+    now = time.time() if now is None else now
+    if not header:
+        return now
+    try:
+        start = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return now
+    # Values from a skewed clock would expire every frame or none
+    return start if now - 60. < start <= now else now
+
+
+class AdmissionController:
+    """Bounded admission queue in front of the scoring pipeline.  A slot
+    that frees up is handed straight to the longest waiting frame, so a
+    newly arrived frame cannot take it first."""
+    def __init__(self, max_in_flight=1, max_queue=0):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Events of the waiting frames, oldest first, set when handed a slot
+        self._waiters = collections.deque()
+        self._counts = {'admitted': 0, 'rejected': 0, 'expired': 0}
+
+    @contextlib.contextmanager
+    def slot(self, deadline=None):
+        """Hold one of the max_in_flight slots for the with-block, waiting
+        in line for one up to deadline (on the time.time() clock).  Raises
+        Rejected if the queue is full or the deadline passes first."""
+        self._acquire(deadline)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self, deadline):
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                self._counts['admitted'] += 1
+                return
+            if len(self._waiters) >= self.max_queue:
+                self._counts['rejected'] += 1
+                raise Rejected('rejected', 'Admission queue is full')
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        timeout = None if deadline is None else max(0., deadline - time.time())
+        waiter.wait(timeout)
+        with self._lock:
+            # A slot handed over just as the deadline passed is still taken
+            if waiter.is_set():
+                self._counts['admitted'] += 1
+                return
+            self._waiters.remove(waiter)
+            self._counts['expired'] += 1
+        raise Rejected('expired', 'Deadline passed before scoring')
+
+    def _release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the next frame in line without freeing up
+                self._waiters.popleft().set()
+            else:
+                self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update(in_flight=self._in_flight, waiting=len(self._waiters))
+            return stats
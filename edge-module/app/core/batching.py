@@ -0,0 +1,113 @@
+"""
+Micro-batching scheduler that groups frames posted by concurrent requests
+so they can be run through the interpreter with a single invoke().
+"""
+import queue
+import threading
+import time
+
+
+class _Request:
+    """A frame waiting to be batched and the slot for its result"""
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScheduler:
+    """Collect items submitted within a short window into one batch.
+
+    run_batch is called from a worker thread with a list of items and must
+    return a list of results in the same order.  A batch is dispatched as
+    soon as max_batch_size items are waiting or max_wait_ms has passed
+    since the first item of the batch arrived.
+    """
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5.0, num_workers=1):
+        self._run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.
+        self._queue = queue.Queue()
+        self._workers = []
+        for i in range(max(1, int(num_workers))):
+            worker = threading.Thread(target=self._worker,
+                                      name='batch-scheduler-{}'.format(i),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, item, timeout=None):
+        """Queue an item and block until its batch has been run"""
+        req = _Request(item)
+        self._queue.put(req)
+        if not req.done.wait(timeout):
+            raise TimeoutError('Batch was not processed within {}s'.format(timeout))
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        """Stop the workers once the items already queued have been run"""
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    req = self._queue.get(timeout=remaining)
+                else:
+                    # Window closed, but take whatever is already waiting
+                    req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                # Hand the stop sentinel back for this or another worker
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _worker(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            try:
+                results = self._run_batch([req.item for req in batch])
+                for req, result in zip(batch, results):
+                    req.result = result
+            except Exception as err:
+                for req in batch:
+                    req.error = err
+            for req in batch:
+                req.done.set()
+
+
+def invoke_batch(invoke, items, model):
+    """Outputs of invoke for each of items, as lists of arrays with a
+    batch dimension of 1.  invoke takes a list of items and returns the
+    outputs for all of them.  The items run as one batch while
+    model.batch_resizable is set, else one at a time; it is cleared the
+    first time the model refuses a batch dimension or returns outputs that
+    do not have one row per item (e.g. a graph that folds the batch into
+    the box axis)."""
+    if model.batch_resizable and len(items) > 1:
+        try:
+            pred = invoke(items)
+        except (RuntimeError, ValueError):
+            pred = None
+        if pred is not None and all(p.shape[0] == len(items) for p in pred):
+            return [[p[i:i + 1] for p in pred] for i in range(len(items))]
+        model.batch_resizable = False
+    return [invoke([item]) for item in items]
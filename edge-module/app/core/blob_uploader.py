@@ -0,0 +1,140 @@
+"""
+Bounded background uploader that sends frames to the local Blob Storage
+IoT Edge module without holding up the /score response.
+"""
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+import core.metrics as metrics
+
+
+class BlobUploader:
+    """Upload frames to edge Blob Storage from background worker threads.
+
+    Jobs are kept in a bounded queue.  When the queue is full the newest
+    frame is dropped (drop_policy='newest') or the oldest queued frame is
+    evicted to make room for it (drop_policy='oldest').  Each job carries a
+    render callable so that JPEG encoding also happens off the request path.
+    """
+    def __init__(self, blob_service_client, max_queue=32, num_workers=2,
+                 max_retries=3, retry_backoff=0.5, drop_policy='newest'):
+        if drop_policy not in ('newest', 'oldest'):
+            raise ValueError('Unknown drop policy: {}'.format(drop_policy))
+        self.blob_service_client = blob_service_client
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = float(retry_backoff)
+        self.drop_policy = drop_policy
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._counts_lock = threading.Lock()
+        self._counts = {'queued': 0, 'uploaded': 0, 'dropped': 0, 'failed': 0, 'retried': 0}
+        # Container clients that are known to exist, by container name
+        self._containers = {}
+        self._containers_lock = threading.Lock()
+        self._workers = []
+        for i in range(max(1, int(num_workers))):
+            worker = threading.Thread(target=self._worker,
+                                      name='blob-uploader-{}'.format(i),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _count(self, name, value=1):
+        with self._counts_lock:
+            self._counts[name] += value
+        metrics.UPLOADS.labels(name).inc(value)
+        metrics.UPLOAD_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def stats(self):
+        """Snapshot of the upload counters and current queue depth"""
+        with self._counts_lock:
+            stats = dict(self._counts)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def submit(self, container_name, blob_name, render, metadata=None):
+        """Queue a frame for upload; render() must return the blob bytes.
+
+        Returns False if the frame was dropped because the queue is full.
+        """
+        job = (container_name, blob_name, render, metadata)
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                self._count('queued')
+                return True
+            except queue.Full:
+                if self.drop_policy == 'newest':
+                    self._count('dropped')
+                    return False
+            try:
+                self._queue.get_nowait()
+                self._count('dropped')
+            except queue.Empty:
+                pass
+
+    def ensure_container(self, container_name):
+        """Create the container if needed and cache its client"""
+        container_client = self.blob_service_client.get_container_client(container_name)
+        try:
+            container_client.create_container()
+        except ResourceExistsError:
+            pass
+        with self._containers_lock:
+            self._containers[container_name] = container_client
+        return container_client
+
+    def ensure_containers(self, container_names):
+        """Verify containers up front; failures are retried on first upload"""
+        for container_name in container_names:
+            try:
+                self.ensure_container(container_name)
+            except Exception:
+                self._report('Error verifying container {}'.format(container_name))
+
+    def _upload(self, container_name, blob_name, data, metadata):
+        container_client = self._containers.get(container_name)
+        if container_client is None:
+            container_client = self.ensure_container(container_name)
+        try:
+            container_client.upload_blob(blob_name, data, metadata=metadata)
+        except ResourceNotFoundError:
+            # Container was removed since it was verified, so recreate it
+            container_client = self.ensure_container(container_name)
+            container_client.upload_blob(blob_name, data, metadata=metadata)
+
+    def _worker(self):
+        while True:
+            container_name, blob_name, render, metadata = self._queue.get()
+            try:
+                data = render()
+            except Exception:
+                self._count('failed')
+                self._report('Error rendering {}'.format(blob_name))
+                continue
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with metrics.timed('upload'):
+                        self._upload(container_name, blob_name, data, metadata)
+                    self._count('uploaded')
+                    break
+                except Exception:
+                    if attempt == self.max_retries:
+                        self._count('failed')
+                        self._report('Error sending {} to local blob storage'.format(blob_name))
+                    else:
+                        self._count('retried')
+                        time.sleep(self.retry_backoff * (2 ** attempt))
+
+    @staticmethod
+    def _report(message):
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        print({'[ERROR]':
+            '{}: {}'.format(message, repr(traceback.format_exception(
+                exc_type,
+                exc_value,
+                exc_traceback)))})
@@ -0,0 +1,114 @@
+"""
+Per-camera class allowlists and regions of interest.
+
+The configuration is a JSON file mapping camera ids to settings, with an
+optional "default" entry for frames that do not name a known camera:
+
+    {
+        "default": {"classes": ["person", "car"]},
+        "loading-dock": {
+            "classes": ["person", "truck"],
+            "rois": [
+                {"rect": [0.0, 0.5, 1.0, 1.0]},
+                {"polygon": [[0.1, 0.1], [0.6, 0.1], [0.4, 0.5]]}
+            ],
+            "store_lowconf": false
+        }
+    }
+
+ROI coordinates are normalized (x, y) with the origin at the top left of
+the frame; "rect" is [xmin, ymin, xmax, ymax].  A box is kept when its
+center lies in any ROI.  Filtering zeroes the raw class scores, so dropped
+classes and boxes never reach NMS, annotation or upload.  store_lowconf
+set to false skips storing frames with no detections left.
+"""
+import json
+
+import numpy as np
+
+
+class CameraFilter:
+    """Class allowlist and ROIs for one camera.  classes=None allows all
+    classes and rois=None the whole frame."""
+    def __init__(self, name, classes=None, rois=None, store_lowconf=True):
+        self.name = name
+        self.classes = list(classes) if classes is not None else None
+        self.rects = []
+        self.polygons = []
+        for roi in rois or []:
+            if 'rect' in roi:
+                xmin, ymin, xmax, ymax = [float(v) for v in roi['rect']]
+                self.rects.append((min(xmin, xmax), min(ymin, ymax),
+                                   max(xmin, xmax), max(ymin, ymax)))
+            elif 'polygon' in roi:
+                polygon = np.asarray(roi['polygon'], dtype=np.float32)
+                if polygon.ndim != 2 or polygon.shape[0] < 3 or polygon.shape[1] != 2:
+                    raise ValueError('ROI polygon needs at least 3 (x, y) points: {}'.format(roi))
+                self.polygons.append(polygon)
+            else:
+                raise ValueError('ROI must have a rect or a polygon: {}'.format(roi))
+        self.has_rois = bool(self.rects or self.polygons)
+        self.store_lowconf = bool(store_lowconf)
+        # (labels, mask) for the label list the mask was last built for
+        self._class_mask = (None, None)
+
+    def class_mask(self, labels):
+        """float32 mask over the classes of labels, 1 for allowed classes"""
+        cached_labels, mask = self._class_mask
+        if cached_labels is not labels:
+            index = {label: i for i, label in enumerate(labels)}
+            unknown = [c for c in self.classes if c not in index]
+            if unknown:
+                print({'[WARNING]': 'Camera {}: unknown classes {}'.format(self.name, unknown)})
+            mask = np.zeros(len(labels), dtype=np.float32)
+            mask[[index[c] for c in self.classes if c in index]] = 1.
+            self._class_mask = (labels, mask)
+        return mask
+
+    def in_roi(self, x, y):
+        """Boolean mask of the normalized points inside any ROI"""
+        inside = np.zeros(x.shape, dtype=bool)
+        for xmin, ymin, xmax, ymax in self.rects:
+            inside |= (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        for polygon in self.polygons:
+            inside |= _in_polygon(x, y, polygon)
+        return inside
+
+    def filter_scores(self, box_xywh, scores, input_size, labels):
+        """Zero the scores of disallowed classes and of boxes centered
+        outside the ROIs.  box_xywh is in input pixels, as the model
+        outputs it; scores is not modified."""
+        if self.classes is not None:
+            scores = scores * self.class_mask(labels)
+        if self.has_rois:
+            x = box_xywh[..., 0] / float(input_size)
+            y = box_xywh[..., 1] / float(input_size)
+            scores = scores * self.in_roi(x, y)[..., np.newaxis]
+        return scores
+
+
+def _in_polygon(x, y, polygon):
+    """Even-odd rule point in polygon test, vectorized over the points"""
+    inside = np.zeros(x.shape, dtype=bool)
+    x1, y1 = polygon[:, 0], polygon[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    for i in range(len(polygon)):
+        crosses = (y1[i] > y) != (y2[i] > y)
+        if not crosses.any():
+            continue
+        # x of the edge at height y; only used where the edge spans y
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_edge = x1[i] + (y - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+        inside ^= crosses & (x < x_edge)
+    return inside
+
+
+def load_camera_config(path):
+    """Read a camera config file into CameraFilters by camera id"""
+    with open(path, 'r') as f:
+        config = json.load(f)
+    return {str(name): CameraFilter(str(name),
+                                    classes=settings.get('classes'),
+                                    rois=settings.get('rois'),
+                                    store_lowconf=settings.get('store_lowconf', True))
+            for name, settings in config.items()}
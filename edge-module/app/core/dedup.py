@@ -0,0 +1,49 @@
+"""
+Near-duplicate frame suppression so static scenes do not fill edge
+storage with copies of the same frame.
+"""
+import threading
+
+import cv2
+import numpy as np
+
+
+def dhash(cvImage, hash_size=8):
+    """Difference hash of a cv2/opencv formatted image as an int of
+    hash_size * hash_size bits"""
+    small = cv2.resize(cvImage, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class FrameDeduplicator:
+    """Remember the last stored frame per key (e.g. blob container) and
+    flag new frames whose hash is within max_distance bits of it and that
+    contain the same set of detected classes."""
+    def __init__(self, max_distance=4, hash_size=8):
+        self.max_distance = int(max_distance)
+        self.hash_size = int(hash_size)
+        self._last = {}
+        self._lock = threading.Lock()
+        self._counts = {'checked': 0, 'suppressed': 0}
+
+    def is_duplicate(self, key, cvImage, classes=()):
+        """True if the frame should be skipped; otherwise it becomes the
+        new reference frame for key."""
+        frame_hash = dhash(cvImage, self.hash_size)
+        classes = frozenset(classes)
+        with self._lock:
+            self._counts['checked'] += 1
+            last = self._last.get(key)
+            if last is not None and last[1] == classes and \
+                    bin(last[0] ^ frame_hash).count('1') <= self.max_distance:
+                self._counts['suppressed'] += 1
+                return True
+            self._last[key] = (frame_hash, classes)
+            return False
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
@@ -0,0 +1,59 @@
+"""
+Rendering of frames for upload: optional downscale, bounding box
+annotation and JPEG encoding with OpenCV or PIL.
+"""
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import core.metrics as metrics
+import core.utils as utils
+
+
+def render_jpeg(cvImage, pred_bbox=None, encoder='cv2', quality=75, max_width=0, rgb=False,
+                classes=None):
+    """Encode a cv2/opencv formatted (BGR, or RGB if rgb is set) frame as
+    JPEG bytes.
+
+    The frame is downscaled first when it is wider than max_width (0 keeps
+    the full size), then annotated with pred_bbox if given.  Boxes are
+    normalized, so they land in the right place at any output size.
+    classes are the label names of the boxes, the configured ones by default.
+    """
+    image = cvImage
+    height, width = image.shape[:2]
+    if max_width and width > max_width:
+        size = (int(max_width), max(1, int(round(height * max_width / width))))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    if encoder == 'cv2':
+        if rgb:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        if pred_bbox is not None:
+            if image is cvImage:
+                image = image.copy()
+            with metrics.timed('annotate'):
+                image = utils.draw_bbox(image, pred_bbox, classes, bgr=True)
+        with metrics.timed('encode'):
+            ok, encoded = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+        if not ok:
+            raise ValueError('cv2.imencode failed to encode frame')
+        return encoded.tobytes()
+
+    if encoder == 'pil':
+        if not rgb:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        elif pred_bbox is not None and image is cvImage:
+            image = image.copy()
+        if pred_bbox is not None:
+            with metrics.timed('annotate'):
+                image = utils.draw_bbox(image, pred_bbox, classes)
+        with metrics.timed('encode'):
+            pil_image = Image.fromarray(image.astype(np.uint8))
+            bytes_io = io.BytesIO()
+            pil_image.save(bytes_io, format='JPEG', quality=int(quality))
+        return bytes_io.getvalue()
+
+    raise ValueError('Unknown JPEG encoder: {}'.format(encoder))
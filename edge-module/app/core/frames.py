@@ -0,0 +1,94 @@
+"""
+Decoding of /score request bodies into frames: encoded images (JPEG/PNG)
+or raw pixel buffers mapped without a decode step.
+"""
+import cv2
+import numpy as np
+
+RAW_PIXEL_FORMATS = ('bgr24', 'rgb24', 'nv12')
+
+# imdecode flags that scale JPEGs down in the DCT domain while decoding
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Start-of-frame markers, which carry the image size (not DHT/JPG/DAC)
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(body):
+    """Read (width, height) from a JPEG header, or None if body is not a
+    JPEG or the header could not be parsed"""
+    if body[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(body):
+        if body[i] != 0xFF:
+            return None
+        marker = body[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # Markers without a length field
+            i += 2
+            continue
+        if marker in _SOF_MARKERS:
+            height = int.from_bytes(body[i + 5:i + 7], 'big')
+            width = int.from_bytes(body[i + 7:i + 9], 'big')
+            return width, height
+        i += 2 + int.from_bytes(body[i + 2:i + 4], 'big')
+    return None
+
+
+def reduction_factor(body, target_size):
+    """Largest JPEG decode reduction (1, 2, 4 or 8) that keeps both sides
+    of the frame at or above target_size pixels"""
+    size = jpeg_size(body)
+    if size is None:
+        return 1
+    for factor in (8, 4, 2):
+        if min(size) // factor >= target_size:
+            return factor
+    return 1
+
+
+def decode_image(body, factor=1):
+    """Decode an encoded image into a cv2/opencv formatted (BGR) frame,
+    optionally reduced by a factor from reduction_factor"""
+    cvImage = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+    if cvImage is None:
+        raise ValueError('Request body is not a decodable image')
+    return cvImage
+
+
+def decode_raw(body, width, height, pixel_format):
+    """Map a raw frame onto an array, returning (frame, is_rgb).
+
+    bgr24 and rgb24 bodies are viewed in place with np.frombuffer, with no
+    copy; nv12 is converted to BGR since the model needs color channels.
+    """
+    pixel_format = pixel_format.lower()
+    if pixel_format not in RAW_PIXEL_FORMATS:
+        raise ValueError('Unsupported pixel format: {}'.format(pixel_format))
+    if width <= 0 or height <= 0:
+        raise ValueError('Raw frames need a positive width and height')
+
+    if pixel_format == 'nv12':
+        expected = width * height * 3 // 2
+        shape = (height * 3 // 2, width)
+    else:
+        expected = width * height * 3
+        shape = (height, width, 3)
+    if len(body) != expected:
+        raise ValueError('Expected {} bytes for a {}x{} {} frame, got {}'.format(
+            expected, width, height, pixel_format, len(body)))
+
+    frame = np.frombuffer(body, dtype=np.uint8).reshape(shape)
+    if pixel_format == 'nv12':
+        return cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_NV12), False
+    return frame, pixel_format == 'rgb24'
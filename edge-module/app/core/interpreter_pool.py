@@ -0,0 +1,222 @@
+"""
+Pool of TFLite interpreters sharing one in-memory copy of the model so
+several frames can be run at once on multi-core boards.  A model file
+preloaded before gunicorn forks is shared by the workers as well.
+"""
+import contextlib
+import os
+import queue
+import time
+
+import numpy as np
+
+import core.metrics as metrics
+
+# Model files read before gunicorn forks its workers, by real path, as
+# (mtime, size, content).  The workers' interpreters reference the buffer
+# without copying it, so its pages stay shared between them.
+_preloaded = {}
+
+
+def load_interpreter_class(backend='auto'):
+    """Interpreter class from tflite_runtime or full TensorFlow.
+
+    'auto' prefers tflite_runtime, which imports in a fraction of the time
+    and memory TensorFlow needs, and falls back to tf.lite.
+    """
+    if backend not in ('auto', 'tflite_runtime', 'tensorflow'):
+        raise ValueError('Unknown TFLite backend: {}'.format(backend))
+    if backend != 'tensorflow':
+        try:
+            from tflite_runtime.interpreter import Interpreter
+            return Interpreter
+        except ImportError:
+            if backend == 'tflite_runtime':
+                raise
+    import tensorflow as tf
+    return tf.lite.Interpreter
+
+
+def _pixel_table(dtype, scale, zero_point):
+    """Quantized value of each uint8 pixel value for an input that expects
+    pixels normalized to [0, 1], or None when the pixels are already it"""
+    info = np.iinfo(dtype)
+    pixels = np.arange(256, dtype=np.float64)
+    if scale:
+        values = np.round(pixels / 255. / scale + zero_point)
+    else:
+        # No quantization parameters: raw pixels, offset into int8's range
+        values = pixels + info.min
+    table = np.clip(values, info.min, info.max).astype(dtype)
+    if dtype == np.uint8 and (table == pixels).all():
+        return None
+    return table
+
+
+def preload_model(path):
+    """Read a model file into memory once, for processes forked later"""
+    path = os.path.realpath(path)
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            _preloaded[path] = (stat.st_mtime, stat.st_size, f.read())
+
+
+def read_model(path):
+    """Content of a model file, preloaded unless it changed since"""
+    path = os.path.realpath(path)
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        preloaded = _preloaded.get(path)
+        if preloaded is not None and preloaded[:2] == (stat.st_mtime, stat.st_size):
+            return preloaded[2]
+        return f.read()
+
+
+class PooledInterpreter:
+    """A TFLite interpreter plus the state needed to run batches on it.
+    input_size resizes the model input to input_size x input_size.
+
+    Quantized (uint8 or int8) models get pixels converted straight to the
+    input's quantized values, without normalizing to float first, and their
+    outputs dequantized to float32 for post-processing.
+    """
+    def __init__(self, model_content, num_threads=None, interpreter_class=None,
+                 input_size=None):
+        interpreter_class = interpreter_class or load_interpreter_class()
+        if num_threads:
+            try:
+                self.interpreter = interpreter_class(model_content=model_content,
+                                                     num_threads=num_threads)
+            except TypeError:
+                # Older TF releases do not take num_threads
+                print({'[WARNING]': 'num_threads not supported by this TFLite version'})
+                self.interpreter = interpreter_class(model_content=model_content)
+        else:
+            self.interpreter = interpreter_class(model_content=model_content)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        shape = self.input_details[0]['shape']
+        if input_size and (shape[1], shape[2]) != (input_size, input_size):
+            self.interpreter.resize_tensor_input(self.input_details[0]['index'],
+                                                 (shape[0], input_size, input_size, shape[3]))
+            self.interpreter.allocate_tensors()
+            self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = int(self.input_details[0]['shape'][0])
+        input_dtype = self.input_details[0]['dtype']
+        self.quantized = input_dtype in (np.uint8, np.int8)
+        if self.quantized:
+            scale, zero_point = self.input_details[0]['quantization']
+            self._input_quantization = (input_dtype, scale, zero_point)
+            self._pixel_table = _pixel_table(input_dtype, scale, zero_point)
+        # (scale, zero point) of quantized outputs, None for float outputs
+        self._output_quantization = [
+            detail['quantization'] if detail['dtype'] in (np.uint8, np.int8) and
+            detail['quantization'][0] else None for detail in self.output_details]
+
+    def _resize_batch(self, shape):
+        """Resize the input tensor when the batch dimension changes"""
+        if self.batch_size == shape[0]:
+            return
+        input_index = self.input_details[0]['index']
+        try:
+            self.interpreter.resize_tensor_input(input_index, shape)
+            self.interpreter.allocate_tensors()
+        except Exception:
+            # Restore the previous shape so the interpreter stays usable
+            self.interpreter.resize_tensor_input(
+                input_index, (self.batch_size,) + tuple(shape[1:]))
+            self.interpreter.allocate_tensors()
+            raise
+        self.batch_size = shape[0]
+
+    def _outputs(self):
+        self.interpreter.invoke()
+        outputs = [self.interpreter.get_tensor(
+            self.output_details[i]['index']) for i in range(len(self.output_details))]
+        for i, quantization in enumerate(self._output_quantization):
+            if quantization is not None:
+                scale, zero_point = quantization
+                output = np.subtract(outputs[i], zero_point, dtype=np.float32)
+                output *= scale
+                outputs[i] = output
+        return outputs
+
+    def invoke(self, image_data):
+        """Run a batch of preprocessed float images"""
+        self._resize_batch(image_data.shape)
+        if self.quantized:
+            dtype, scale, zero_point = self._input_quantization
+            info = np.iinfo(dtype)
+            if scale:
+                image_data = image_data / scale + zero_point
+            else:
+                image_data = image_data * 255. + info.min
+            image_data = np.clip(np.round(image_data), info.min, info.max).astype(dtype)
+        self.interpreter.set_tensor(self.input_details[0]['index'], image_data)
+        return self._outputs()
+
+    def invoke_frames(self, frames):
+        """Run resized RGB uint8 frames, scaling each one straight into the
+        interpreter's input buffer instead of building a float copy first.
+        Quantized inputs take the pixels as they are or through a lookup
+        table."""
+        self._resize_batch((len(frames),) + frames[0].shape)
+        input_data = self.interpreter.tensor(self.input_details[0]['index'])()
+        for i, frame in enumerate(frames):
+            if not self.quantized:
+                np.divide(frame, 255., out=input_data[i], dtype=np.float32)
+            elif self._pixel_table is None:
+                input_data[i] = frame
+            else:
+                np.take(self._pixel_table, frame, out=input_data[i])
+        # invoke() refuses to run while views of the input buffer are alive
+        del input_data
+        return self._outputs()
+
+
+class InterpreterPool:
+    """Fixed-size pool of interpreters built from a single model buffer.
+    model_content reuses the buffer of another pool of the same model, and
+    input_size resizes the model input (see PooledInterpreter)."""
+    def __init__(self, model_path, size=1, num_threads=None, backend='auto',
+                 input_size=None, model_content=None):
+        if model_content is None:
+            model_content = read_model(model_path)
+        self.model_content = model_content
+        self.size = max(1, int(size))
+        interpreter_class = load_interpreter_class(backend)
+        self._available = queue.Queue()
+        for _ in range(self.size):
+            self._available.put(PooledInterpreter(self.model_content, num_threads,
+                                                  interpreter_class, input_size))
+        runner = self._available.queue[0]
+        # (height, width, channels) expected for each frame
+        self.input_shape = tuple(int(d) for d in runner.input_details[0]['shape'][1:])
+        # Whether the model takes uint8 or int8 pixels rather than floats
+        self.quantized = runner.quantized
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Borrow an interpreter for the duration of the with-block"""
+        start = time.perf_counter()
+        runner = self._available.get()
+        metrics.INTERPRETER_WAIT.inc(time.perf_counter() - start)
+        try:
+            yield runner
+        finally:
+            self._available.put(runner)
+
+    def warm_up(self, runs=1):
+        """Invoke every interpreter on blank frames so the first real
+        requests do not pay for lazy allocation and kernel setup."""
+        frame = np.zeros(self.input_shape, dtype=np.uint8)
+        runners = [self._available.get() for _ in range(self.size)]
+        try:
+            for runner in runners:
+                for _ in range(runs):
+                    runner.invoke_frames([frame])
+        finally:
+            for runner in runners:
+                self._available.put(runner)
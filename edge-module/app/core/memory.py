@@ -0,0 +1,30 @@
+"""
+Memory use of the current process, to compare gunicorn workers with and
+without the model preloaded before fork.
+"""
+
+
+def process_memory():
+    """Resident memory of this process in MB: rss, and where the kernel
+    reports them, pss (shared pages divided between the processes sharing
+    them), shared and private.  Empty off Linux."""
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+              'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    memory = {}
+    try:
+        # Linux 4.14+; older kernels (e.g. L4T on Jetson Nano) only have VmRSS
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                parts = line.split()
+                key = fields.get(parts[0].rstrip(':'))
+                if key is not None:
+                    memory[key] = memory.get(key, 0) + int(parts[1])
+    except (IOError, OSError, ValueError, IndexError):
+        try:
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        memory['rss'] = int(line.split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            return {}
+    return {key: round(kb / 1024., 1) for key, kb in memory.items()}
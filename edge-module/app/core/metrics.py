@@ -0,0 +1,97 @@
+"""
+Prometheus metrics for the scoring service.
+
+Stage latencies are histograms labelled by stage; frames, detections,
+interpreter wait time and uploads are counters.  Under gunicorn each worker
+writes its samples to PROMETHEUS_MULTIPROC_DIR (set up in gunicorn.conf.py)
+and /metrics aggregates them, so the numbers cover all workers whichever one
+answers the scrape.  Without prometheus_client installed every metric is a
+no-op.
+"""
+import contextlib
+import os
+import time
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    prometheus_client = None
+
+STAGES = ('decode', 'preprocess', 'invoke', 'nms', 'annotate', 'encode', 'upload')
+# Seconds; stages range from sub-millisecond NMS to multi-second uploads
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class _NoOpMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+enabled = prometheus_client is not None
+
+if enabled:
+    STAGE_SECONDS = Histogram('yolo_stage_seconds',
+                              'Time spent in each stage of scoring and storing a frame',
+                              ['stage'], buckets=BUCKETS)
+    FRAMES = Counter('yolo_frames_total', 'Frames received, by outcome', ['outcome'])
+    DETECTIONS = Counter('yolo_detections_total',
+                         'Detections above the score threshold, by class', ['label'])
+    INTERPRETER_WAIT = Counter('yolo_interpreter_wait_seconds_total',
+                               'Time spent waiting for a free interpreter')
+    UPLOADS = Counter('yolo_uploads_total',
+                      'Frames for blob storage, by outcome '
+                      '(queued, uploaded, failed, dropped or retried)', ['outcome'])
+    UPLOAD_QUEUE_DEPTH = Gauge('yolo_upload_queue_depth',
+                               'Frames waiting to be uploaded', multiprocess_mode='livesum')
+    INPUT_SIZE_FRAMES = Counter('yolo_input_size_frames_total',
+                                'Frames scored by the adaptive mode, by model input size',
+                                ['size'])
+else:
+    STAGE_SECONDS = FRAMES = DETECTIONS = INTERPRETER_WAIT = UPLOADS = \
+        UPLOAD_QUEUE_DEPTH = INPUT_SIZE_FRAMES = _NoOpMetric()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Observe the duration of the with-block as the given stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def multiprocess_dir():
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')
+
+
+def render():
+    """Exposition text for all metrics and its content type"""
+    if not enabled:
+        raise RuntimeError('prometheus_client is not installed')
+    registry = prometheus_client.REGISTRY
+    if multiprocess_dir():
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Drop the live gauge samples of an exited gunicorn worker"""
+    if enabled and multiprocess_dir():
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
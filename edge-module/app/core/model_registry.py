@@ -0,0 +1,271 @@
+"""
+Versioned model registry with background loading, warm-up and hot-swap.
+
+The registry is a directory with one sub-directory per model version:
+
+    <root>/
+        CURRENT               name of the active version
+        v1/model.tflite
+        v1/labels.names       optional, defaults to the built-in labels
+        v2/model.tflite
+        ...
+
+Activating a version loads and warms it up in the background, then swaps
+it in for new requests; requests already running finish on the version
+they started with, which is released once the last of them returns.
+"""
+import contextlib
+import os
+import sys
+import threading
+import time
+import traceback
+
+from core.interpreter_pool import InterpreterPool
+
+MODEL_FILE = 'model.tflite'
+LABELS_FILE = 'labels.names'
+CURRENT_FILE = 'CURRENT'
+
+
+def read_labels(path):
+    with open(path, 'r') as f:
+        return [l.rstrip() for l in f]
+
+
+class LoadedModel:
+    """One model version: its interpreter pools, labels and per-model state.
+
+    pools holds an interpreter pool per input size: the model's own and
+    each of sizes, from a copy of the model converted at that size saved
+    next to it as <name>-<size>.tflite, else by resizing the model input,
+    which models with fixed shapes inside do not allow.
+    """
+    def __init__(self, version, model_path, labels, pool_size=1, num_threads=None,
+                 backend='auto', sizes=()):
+        self.version = version
+        self.model_path = model_path
+        self.labels = labels
+        self.pool = InterpreterPool(model_path, size=pool_size, num_threads=num_threads,
+                                    backend=backend)
+        self.input_size = self.pool.input_shape[0]
+        self.pools = {self.input_size: self.pool}
+        for size in sizes:
+            if size in self.pools:
+                continue
+            stem, ext = os.path.splitext(model_path)
+            sized_path = '{}-{}{}'.format(stem, size, ext)
+            try:
+                if os.path.isfile(sized_path):
+                    pool = InterpreterPool(sized_path, size=pool_size, num_threads=num_threads,
+                                           backend=backend)
+                    if pool.input_shape[:2] != (size, size):
+                        raise ValueError('{} takes {} inputs'.format(sized_path,
+                                                                    pool.input_shape))
+                else:
+                    pool = InterpreterPool(model_path, size=pool_size, num_threads=num_threads,
+                                           backend=backend, input_size=size,
+                                           model_content=self.pool.model_content)
+                # Models with fixed shapes inside may only fail on invoke
+                pool.warm_up(1)
+                self.pools[size] = pool
+            except Exception as err:
+                print({'[WARNING]': 'Model {} cannot run at input size {}: {}'.format(
+                    version, size, repr(err))})
+        # Cleared the first time the model refuses a batch dimension
+        self.batch_resizable = True
+        # Optional BatchSchedulers by input size attached by the caller,
+        # stopped on release
+        self.schedulers = {}
+        self.loaded_at = time.time()
+        self._in_flight = 0
+        self._retired = False
+
+    def close(self):
+        for scheduler in self.schedulers.values():
+            scheduler.stop()
+        self.schedulers = {}
+
+
+class ModelRegistry:
+    """Hold the active model and swap in new versions without downtime.
+
+    With no root directory the registry serves default_path as version
+    'default' and cannot switch versions.  setup(model) is called on every
+    newly loaded model before it is warmed up, and sizes are extra input
+    sizes to load every model at.
+    """
+    def __init__(self, root, default_path, default_labels, pool_size=1,
+                 num_threads=None, warmup_runs=3, setup=None, backend='auto', sizes=()):
+        self.root = root or None
+        self.default_path = default_path
+        self.default_labels = default_labels
+        self.pool_size = pool_size
+        self.num_threads = num_threads
+        self.backend = backend
+        self.sizes = tuple(sizes)
+        self.warmup_runs = max(0, int(warmup_runs))
+        self.setup = setup
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._active = None
+        self._load_status = {'state': 'idle'}
+
+        version = self.current_version()
+        if version is not None:
+            try:
+                self._active = self._load(version)
+            except Exception as err:
+                print({'[ERROR]': 'Error loading model version {}, serving {}: {}'.format(
+                    version, default_path, repr(err))})
+                self._load_status = {'state': 'failed', 'version': version, 'error': repr(err)}
+        if self._active is None:
+            self._active = self._build('default', default_path, default_labels)
+
+    def versions(self):
+        """Versions available in the registry directory"""
+        if self.root is None or not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isfile(os.path.join(self.root, name, MODEL_FILE)))
+
+    def current_version(self):
+        """Version named in the CURRENT file, if any"""
+        if self.root is None:
+            return None
+        try:
+            with open(os.path.join(self.root, CURRENT_FILE), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @property
+    def active_version(self):
+        return self._active.version
+
+    def status(self):
+        with self._lock:
+            load_status = dict(self._load_status)
+        return {'active': self._active.version,
+                'loaded_at': self._active.loaded_at,
+                'versions': self.versions(),
+                'load': load_status}
+
+    @contextlib.contextmanager
+    def active(self):
+        """Pin the active model for the duration of a request"""
+        with self._lock:
+            model = self._active
+            model._in_flight += 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                model._in_flight -= 1
+                release = model._retired and model._in_flight == 0
+            if release:
+                model.close()
+
+    def _build(self, version, model_path, labels):
+        model = LoadedModel(version, model_path, labels,
+                            pool_size=self.pool_size, num_threads=self.num_threads,
+                            backend=self.backend, sizes=self.sizes)
+        if self.setup is not None:
+            self.setup(model)
+        if self.warmup_runs:
+            for pool in model.pools.values():
+                pool.warm_up(self.warmup_runs)
+        return model
+
+    def _load(self, version):
+        if self.root is None:
+            raise ValueError('No model registry directory is configured')
+        if os.path.basename(version) != version or version in ('', '.', '..'):
+            raise ValueError('Bad model version: {}'.format(version))
+        model_dir = os.path.join(self.root, version)
+        model_path = os.path.join(model_dir, MODEL_FILE)
+        if not os.path.isfile(model_path):
+            raise ValueError('Unknown model version: {}'.format(version))
+        labels_path = os.path.join(model_dir, LABELS_FILE)
+        labels = read_labels(labels_path) if os.path.isfile(labels_path) else self.default_labels
+        return self._build(version, model_path, labels)
+
+    def _write_current(self, version):
+        current_path = os.path.join(self.root, CURRENT_FILE)
+        tmp_path = '{}.{}.tmp'.format(current_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, current_path)
+
+    def activate(self, version, persist=True):
+        """Load, warm up and swap in a version.  Blocks until it is serving."""
+        with self._load_lock:
+            return self._activate(version, persist)
+
+    def _activate(self, version, persist):
+        with self._lock:
+            self._load_status = {'state': 'loading', 'version': version,
+                                 'started_at': time.time()}
+        try:
+            model = self._load(version)
+        except Exception as err:
+            with self._lock:
+                self._load_status = {'state': 'failed', 'version': version,
+                                     'error': repr(err)}
+            raise
+        with self._lock:
+            old, self._active = self._active, model
+            old._retired = True
+            release = old._in_flight == 0
+            self._load_status = {'state': 'ready', 'version': version,
+                                 'finished_at': time.time()}
+        if release:
+            old.close()
+        if persist:
+            self._write_current(version)
+        return model
+
+    def activate_async(self, version, persist=True):
+        """Activate a version from a background thread.  Returns False if a
+        load is already in progress."""
+        if not self._load_lock.acquire(blocking=False):
+            return False
+        thread = threading.Thread(target=self._activate_logged, args=(version, persist),
+                                  name='model-loader', daemon=True)
+        thread.start()
+        return True
+
+    def _activate_logged(self, version, persist):
+        """Run _activate with the load lock already held and log the outcome"""
+        try:
+            self._activate(version, persist)
+            print({'[INFO]': 'Model version {} is now serving'.format(version)})
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            print({'[ERROR]':
+                'Error activating model version {}: {}'.format(version,
+                 repr(traceback.format_exception(
+                     exc_type,
+                     exc_value,
+                     exc_traceback)))})
+        finally:
+            self._load_lock.release()
+
+    def watch(self, interval):
+        """Follow changes to the CURRENT file, e.g. a version activated
+        through another gunicorn worker or by editing the file directly."""
+        if self.root is None or interval <= 0:
+            return
+        def poll():
+            while True:
+                time.sleep(interval)
+                version = self.current_version()
+                if version is None or version == self._active.version:
+                    continue
+                # Do not retry a version that failed until CURRENT changes
+                status = self._load_status
+                if status.get('state') == 'failed' and status.get('version') == version:
+                    continue
+                if self._load_lock.acquire(blocking=False):
+                    self._activate_logged(version, False)
+        threading.Thread(target=poll, name='model-registry-watch', daemon=True).start()
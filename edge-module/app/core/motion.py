@@ -0,0 +1,67 @@
+"""
+Motion gate that lets unchanged frames reuse the last detections of their
+camera instead of going through inference, NMS and upload again.
+"""
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+def thumbnail(cvImage, size=64, rgb=False):
+    """Tiny grayscale copy of a cv2/opencv formatted image"""
+    small = cv2.resize(cvImage, (size, size), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    return small
+
+
+class MotionGate:
+    """Keep a thumbnail of the last scored frame and its result per key
+    (camera).  A frame is unchanged when fewer than threshold (a fraction)
+    of its thumbnail pixels differ by more than pixel_delta gray levels from
+    that reference.  Comparing with the last scored frame rather than the
+    previous one means slow changes add up instead of slipping through, and
+    results are refreshed at least every refresh_s seconds regardless.
+    """
+    def __init__(self, threshold=0.01, pixel_delta=15, refresh_s=10., size=64, max_keys=256):
+        self.threshold = float(threshold)
+        self.pixel_delta = int(pixel_delta)
+        self.refresh_s = float(refresh_s)
+        self.size = int(size)
+        self.max_keys = int(max_keys)
+        # key -> (thumbnail, result, time scored), oldest key first
+        self._last = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {'checked': 0, 'skipped': 0}
+
+    def check(self, key, cvImage, rgb=False):
+        """Returns (cached result or None, thumbnail).  When the result is
+        None the frame has to be scored and passed to update() with the
+        thumbnail."""
+        small = thumbnail(cvImage, self.size, rgb)
+        with self._lock:
+            self._counts['checked'] += 1
+            last = self._last.get(key)
+        if last is None or time.monotonic() - last[2] >= self.refresh_s:
+            return None, small
+        diff = cv2.absdiff(small, last[0])
+        if np.count_nonzero(diff > self.pixel_delta) >= self.threshold * diff.size:
+            return None, small
+        with self._lock:
+            self._counts['skipped'] += 1
+        return last[1], small
+
+    def update(self, key, small, result):
+        """Make a scored frame the reference for key"""
+        with self._lock:
+            self._last.pop(key, None)
+            self._last[key] = (small, result, time.monotonic())
+            while len(self._last) > self.max_keys:
+                self._last.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
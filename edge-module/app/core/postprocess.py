@@ -0,0 +1,129 @@
+"""
+NumPy post-processing for YOLO v4 TFLite outputs.  Mirrors
+core.yolov4.filter_boxes and tf.image.combined_non_max_suppression without
+the eager TensorFlow op dispatch, which dominates for tensors this small.
+"""
+import numpy as np
+
+
+def filter_boxes(box_xywh, scores, score_threshold=0.4, input_shape=(416, 416)):
+    """Keep predictions whose best class score passes the threshold and
+    convert them from (x, y, w, h) in pixels to normalized
+    (ymin, xmin, ymax, xmax), as core.yolov4.filter_boxes does.
+    """
+    scores_max = np.max(scores, axis=-1)
+    mask = scores_max >= score_threshold
+    batch_size = scores.shape[0]
+    class_boxes = box_xywh[mask].reshape(batch_size, -1, box_xywh.shape[-1])
+    pred_conf = scores[mask].reshape(batch_size, -1, scores.shape[-1])
+
+    input_shape = np.asarray(input_shape, dtype=np.float32)
+    box_yx = class_boxes[..., 1::-1]
+    box_hw = class_boxes[..., 3:1:-1]
+    box_mins = (box_yx - (box_hw / 2.)) / input_shape
+    box_maxes = (box_yx + (box_hw / 2.)) / input_shape
+    boxes = np.concatenate([box_mins, box_maxes], axis=-1).astype(np.float32)
+    return boxes, pred_conf
+
+
+def _corners(boxes):
+    """Order (ymin, xmin, ymax, xmax) corners and compute box areas"""
+    ymin = np.minimum(boxes[..., 0], boxes[..., 2])
+    xmin = np.minimum(boxes[..., 1], boxes[..., 3])
+    ymax = np.maximum(boxes[..., 0], boxes[..., 2])
+    xmax = np.maximum(boxes[..., 1], boxes[..., 3])
+    return ymin, xmin, ymax, xmax, (ymax - ymin) * (xmax - xmin)
+
+
+def _iou(corners1, corners2):
+    """IoU between two sets of broadcastable corners from _corners"""
+    ymin1, xmin1, ymax1, xmax1, area1 = corners1
+    ymin2, xmin2, ymax2, xmax2, area2 = corners2
+    inter_h = np.maximum(np.minimum(ymax1, ymax2) - np.maximum(ymin1, ymin2), 0.)
+    inter_w = np.maximum(np.minimum(xmax1, xmax2) - np.maximum(xmin1, xmin2), 0.)
+    inter = inter_h * inter_w
+    union = area1 + area2 - inter
+    valid = (area1 > 0) & (area2 > 0) & (union > 0)
+    return np.divide(inter, union, out=np.zeros_like(inter), where=valid)
+
+
+def iou_matrix(boxes1, boxes2):
+    """Pairwise IoU of (ymin, xmin, ymax, xmax) boxes, in either corner order"""
+    corners1 = [c[:, None] for c in _corners(boxes1)]
+    corners2 = [c[None, :] for c in _corners(boxes2)]
+    return _iou(corners1, corners2)
+
+
+def _nms_single(boxes, scores, max_output_size_per_class, max_total_size,
+                iou_threshold, score_threshold):
+    """Per-class greedy NMS for one image.  boxes is (N, 4), scores (N, C)."""
+    box_ind, class_ind = np.nonzero(scores > score_threshold)
+    if len(box_ind) == 0:
+        return (np.zeros((0, 4), np.float32), np.zeros((0,), np.float32),
+                np.zeros((0,), np.float32))
+    cand_scores = scores[box_ind, class_ind]
+    order = np.argsort(-cand_scores, kind='stable')
+    box_ind, class_ind, cand_scores = box_ind[order], class_ind[order], cand_scores[order]
+    cand_boxes = boxes[box_ind]
+    corners = _corners(cand_boxes)
+
+    # Candidate positions of each class, in descending score order
+    by_class = np.argsort(class_ind, kind='stable')
+    splits = np.flatnonzero(np.diff(class_ind[by_class])) + 1
+    members = {int(class_ind[group[0]]): group for group in np.split(by_class, splits)}
+
+    suppressed = np.zeros(len(cand_scores), dtype=bool)
+    per_class = np.zeros(scores.shape[-1], dtype=np.int64)
+    keep = []
+    for i in range(len(cand_scores)):
+        if suppressed[i]:
+            continue
+        cls = class_ind[i]
+        if per_class[cls] >= max_output_size_per_class:
+            continue
+        keep.append(i)
+        per_class[cls] += 1
+        # Candidates are sorted by score, so anything after this point
+        # would be cut by the total limit anyway
+        if len(keep) == max_total_size:
+            break
+        rest = members[int(cls)]
+        rest = rest[rest > i]
+        if len(rest):
+            iou = _iou([c[i] for c in corners], [c[rest] for c in corners])
+            suppressed[rest[iou > iou_threshold]] = True
+
+    keep = np.asarray(keep, dtype=np.int64)
+    return (cand_boxes[keep], cand_scores[keep], class_ind[keep].astype(np.float32))
+
+
+def combined_non_max_suppression(boxes, scores, max_output_size_per_class,
+                                 max_total_size, iou_threshold=0.5,
+                                 score_threshold=float('-inf'), clip_boxes=True):
+    """NumPy equivalent of tf.image.combined_non_max_suppression for boxes
+    shared across classes.
+
+    boxes is (batch, N, 4) or (batch, N, 1, 4) and scores (batch, N, C).
+    Returns (nmsed_boxes, nmsed_scores, nmsed_classes, valid_detections)
+    padded to max_total_size, with the same shapes and dtypes as TF.
+    """
+    batch_size = scores.shape[0]
+    boxes = boxes.reshape(batch_size, -1, 4)
+    nmsed_boxes = np.zeros((batch_size, max_total_size, 4), np.float32)
+    nmsed_scores = np.zeros((batch_size, max_total_size), np.float32)
+    nmsed_classes = np.zeros((batch_size, max_total_size), np.float32)
+    valid_detections = np.zeros((batch_size,), np.int32)
+
+    for b in range(batch_size):
+        sel_boxes, sel_scores, sel_classes = _nms_single(
+            boxes[b], scores[b], max_output_size_per_class, max_total_size,
+            iou_threshold, score_threshold)
+        num = len(sel_scores)
+        if clip_boxes:
+            sel_boxes = np.clip(sel_boxes, 0., 1.)
+        nmsed_boxes[b, :num] = sel_boxes
+        nmsed_scores[b, :num] = sel_scores
+        nmsed_classes[b, :num] = sel_classes
+        valid_detections[b] = num
+
+    return nmsed_boxes, nmsed_scores, nmsed_classes, valid_detections
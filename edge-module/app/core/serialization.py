@@ -0,0 +1,115 @@
+"""
+Response bodies for /score built straight from the detection arrays.
+
+The default JSON is the LVA inference format that Postprocess and
+json.dumps produce, with values as strings, but it is formatted from a
+per-detection template instead of nested dicts.  It can also carry numbers
+instead of strings, or the detections can be sent in a compact binary form:
+
+* application/msgpack: {"inferences": [{"label": str, "confidence": float,
+  "box": [l, t, w, h]}, ...]} (needs the msgpack package)
+* application/octet-stream: little-endian float32 rows of
+  (class index, confidence, l, t, w, h)
+
+With tracking on, JSON entities and msgpack inferences carry a trackingId
+and float32 rows get the track id as a seventh column.
+"""
+import json
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+OCTET_STREAM = 'application/octet-stream'
+# JSON first, so that */* and a missing Accept header keep the LVA format
+MIMETYPES = [JSON, OCTET_STREAM] + ([MSGPACK, 'application/x-msgpack'] if msgpack else [])
+
+# The last field is empty or the trackingId member
+_ENTITY = ('{"type": "entity", "entity": {"tag": {"value": %s, "confidence": "%s"}, '
+           '"box": {"l": "%s", "t": "%s", "w": "%s", "h": "%s"}%s}}')
+# Six decimals is well below a pixel for normalized coordinates
+_ENTITY_NUMERIC = ('{"type": "entity", "entity": {"tag": {"value": %s, "confidence": %.6f}, '
+                   '"box": {"l": %.6f, "t": %.6f, "w": %.6f, "h": %.6f}%s}}')
+
+
+class Detections:
+    """Detections that passed the score threshold.  boxes are normalized
+    (ymin, xmin, ymax, xmax) rows, classes index into labels and track_ids,
+    if tracking is on, identify the tracked object of each detection.
+    input_size is the model input size the frame was scored at, if known."""
+    __slots__ = ('boxes', 'scores', 'classes', 'labels', 'track_ids', 'input_size')
+
+    def __init__(self, boxes, scores, classes, labels, track_ids=None, input_size=None):
+        self.boxes = boxes
+        self.scores = scores
+        self.classes = classes
+        self.labels = labels
+        self.track_ids = track_ids
+        self.input_size = input_size
+
+    def __len__(self):
+        return len(self.scores)
+
+    def ltwh(self):
+        """(left, top, width, height) columns as in the LVA box format"""
+        ymin, xmin, ymax, xmax = self.boxes.T
+        return xmin, ymin, xmax - xmin, ymax - ymin
+
+
+def to_json(detections, numeric=False):
+    """{"inferences": [...]} as UTF-8 bytes.  Values are strings, exactly as
+    str() of the float32 values renders them, unless numeric is set."""
+    left, top, width, height = detections.ltwh()
+    columns = [detections.scores, left, top, width, height]
+    if numeric:
+        template = _ENTITY_NUMERIC
+        columns = [c.tolist() for c in columns]
+    else:
+        template = _ENTITY
+        # astype(str) matches str() of each float32 without a Python loop
+        columns = [c.astype(str).tolist() for c in columns]
+    labels = [json.dumps(detections.labels[int(c)]) for c in detections.classes.tolist()]
+    if detections.track_ids is None:
+        tracking = [''] * len(labels)
+    else:
+        tracking = [', "trackingId": "{}"'.format(i) for i in detections.track_ids.tolist()]
+    entities = [template % row for row in zip(labels, *(columns + [tracking]))]
+    return ('{"inferences": [' + ', '.join(entities) + ']}').encode('utf-8')
+
+
+def to_msgpack(detections):
+    left, top, width, height = detections.ltwh()
+    inferences = [{'label': detections.labels[int(c)], 'confidence': s, 'box': [l, t, w, h]}
+                  for c, s, l, t, w, h in zip(detections.classes.tolist(),
+                                              detections.scores.tolist(),
+                                              left.tolist(), top.tolist(),
+                                              width.tolist(), height.tolist())]
+    if detections.track_ids is not None:
+        for inference, track_id in zip(inferences, detections.track_ids.tolist()):
+            inference['trackingId'] = str(track_id)
+    return msgpack.packb({'inferences': inferences}, use_bin_type=True)
+
+
+def to_float32(detections):
+    left, top, width, height = detections.ltwh()
+    columns = [detections.classes, detections.scores, left, top, width, height]
+    if detections.track_ids is not None:
+        columns.append(detections.track_ids)
+    rows = np.stack([c.astype(np.float32) for c in columns], axis=-1)
+    return rows.astype('<f4').tobytes()
+
+
+def serialize(detections, mimetype=JSON, numeric=False):
+    """Body for the negotiated mimetype, one of MIMETYPES"""
+    if mimetype == JSON:
+        return to_json(detections, numeric)
+    if mimetype == OCTET_STREAM:
+        return to_float32(detections)
+    if msgpack is not None and mimetype in (MSGPACK, 'application/x-msgpack'):
+        return to_msgpack(detections)
+    raise ValueError('Unsupported response type: {}'.format(mimetype))
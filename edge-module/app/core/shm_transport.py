@@ -0,0 +1,191 @@
+"""
+Shared-memory frame transport.  A producer writes frames into slots of a
+ring buffer backed by a file in /dev/shm and sends a small JSON descriptor
+per frame over a Unix domain socket; the server reads the frame in place
+and answers on the same socket with the detections.
+
+Protocol (newline-delimited JSON, one line per message):
+
+    producer -> server  {"type": "hello", "shm": "/dev/shm/name",
+                         "slot_count": 4, "slot_size": 6220800}
+    producer -> server  {"type": "frame", "slot": 0, "width": 1920,
+                         "height": 1080, "pixel_format": "bgr24",
+                         "length": 6220800, "timestamp": 1600000000.0,
+                         "camera": "entrance"}
+    server -> producer  {"slot": 0, "timestamp": 1600000000.0,
+                         "inferences": [...]}
+
+A slot belongs to the server from the moment its descriptor is sent until
+the reply for it arrives.  pixel_format may also be "jpeg", in which case
+length gives the size of the encoded image in the slot.  camera is optional
+and selects the camera's class and region filters.
+"""
+import errno
+import json
+import mmap
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import core.frames as frames
+
+
+class ShmFrameServer:
+    """Accept producer connections on a Unix socket and run handler on
+    every frame they describe.
+
+    handler(frame, rgb, camera) receives a read-only array backed by the
+    shared memory slot, valid only until it returns, and the camera id of
+    the frame (or None), and must return the list of inferences to send back.
+    """
+    def __init__(self, socket_path, handler):
+        self.socket_path = socket_path
+        self.handler = handler
+        self._sock = None
+
+    def start(self):
+        """Bind the socket and serve from a daemon thread.  Returns False if
+        another live process (e.g. a sibling gunicorn worker) already owns
+        the socket."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.socket_path)
+        except OSError as err:
+            if err.errno != errno.EADDRINUSE or self._socket_alive():
+                sock.close()
+                return False
+            # Left behind by a process that has exited
+            os.unlink(self.socket_path)
+            sock.bind(self.socket_path)
+        sock.listen(8)
+        self._sock = sock
+        threading.Thread(target=self._accept_loop, name='shm-transport', daemon=True).start()
+        return True
+
+    def _socket_alive(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def _accept_loop(self):
+        while True:
+            conn, _ = self._sock.accept()
+            threading.Thread(target=self._serve, args=(conn,),
+                             name='shm-transport-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        ring = None
+        slot_size = 0
+        try:
+            with conn, conn.makefile('rb') as reader:
+                for line in reader:
+                    message = json.loads(line.decode('utf-8'))
+                    if message.get('type') == 'hello':
+                        ring, slot_size = self._open_ring(message)
+                        continue
+                    reply = self._handle_frame(message, ring, slot_size)
+                    conn.sendall((json.dumps(reply) + '\n').encode('utf-8'))
+        except Exception:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            print({'[ERROR]':
+                'Error in shared memory transport: {}'.format(
+                 repr(traceback.format_exception(
+                     exc_type,
+                     exc_value,
+                     exc_traceback)))})
+        finally:
+            if ring is not None:
+                try:
+                    ring.close()
+                except BufferError:
+                    # A frame view is still referenced; unmapped once collected
+                    pass
+
+    @staticmethod
+    def _open_ring(message):
+        slot_size = int(message['slot_size'])
+        with open(message['shm'], 'rb') as f:
+            ring = mmap.mmap(f.fileno(), slot_size * int(message['slot_count']),
+                             access=mmap.ACCESS_READ)
+        return ring, slot_size
+
+    def _handle_frame(self, message, ring, slot_size):
+        slot = message.get('slot')
+        reply = {'slot': slot, 'timestamp': message.get('timestamp')}
+        try:
+            if ring is None:
+                raise ValueError('No shared memory attached, send hello first')
+            pixel_format = message.get('pixel_format', 'bgr24')
+            width = int(message.get('width', 0))
+            height = int(message.get('height', 0))
+            length = int(message.get('length', 0))
+            if length <= 0 or length > slot_size:
+                raise ValueError('Bad frame length {} for slot size {}'.format(length, slot_size))
+            start = int(slot) * slot_size
+            buffer = memoryview(ring)[start:start + length]
+            frame = None
+            try:
+                if pixel_format == 'jpeg':
+                    frame, rgb = frames.decode_image(buffer), False
+                else:
+                    frame, rgb = frames.decode_raw(buffer, width, height, pixel_format)
+                reply['inferences'] = self.handler(frame, rgb, message.get('camera'))
+            finally:
+                # The ring cannot be closed while views of it are alive
+                del frame
+                try:
+                    buffer.release()
+                except BufferError:
+                    pass
+        except Exception as err:
+            reply['error'] = repr(err)
+        return reply
+
+
+class ShmFrameClient:
+    """Producer side of the transport, standing in for LVA when testing"""
+    def __init__(self, socket_path, shm_path, slot_count=4, slot_size=1920 * 1080 * 3):
+        self.shm_path = shm_path
+        self.slot_count = int(slot_count)
+        self.slot_size = int(slot_size)
+        self._next_slot = 0
+        with open(shm_path, 'w+b') as f:
+            f.truncate(self.slot_count * self.slot_size)
+            self._ring = mmap.mmap(f.fileno(), self.slot_count * self.slot_size)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._reader = self._sock.makefile('rb')
+        self._send({'type': 'hello', 'shm': shm_path,
+                    'slot_count': self.slot_count, 'slot_size': self.slot_size})
+
+    def _send(self, message):
+        self._sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+    def score(self, data, width=0, height=0, pixel_format='bgr24', timestamp=None,
+              camera=None):
+        """Copy a frame into the next slot and wait for its detections"""
+        data = memoryview(data).cast('B')
+        if len(data) > self.slot_size:
+            raise ValueError('Frame of {} bytes does not fit a {} byte slot'.format(
+                len(data), self.slot_size))
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.slot_count
+        start = slot * self.slot_size
+        self._ring[start:start + len(data)] = data
+        self._send({'type': 'frame', 'slot': slot, 'width': width, 'height': height,
+                    'pixel_format': pixel_format, 'length': len(data),
+                    'timestamp': timestamp, 'camera': camera})
+        return json.loads(self._reader.readline().decode('utf-8'))
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+        self._ring.close()
+        os.unlink(self.shm_path)
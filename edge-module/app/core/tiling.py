@@ -0,0 +1,114 @@
+"""
+Tiled inference for frames much larger than the model input.
+
+A frame is cut into overlapping square windows of tile_size frame pixels,
+each letterboxed into the model input as core.utils.image_preprocess does,
+and optionally the whole frame letterboxed as one more tile for objects too
+large for a window.  The tiles run as one batch; their boxes are then mapped
+back into the frame and merged by one NMS across all tiles.
+
+Boxes are mapped into the frame scaled to input_size x input_size, the
+space the untiled model outputs are in, so the usual filter and NMS code
+normalizes them to frame coordinates unchanged.
+"""
+import cv2
+import numpy as np
+
+# Gray padding of image_preprocess
+_PAD = 128
+# Boxes within this many input pixels of a window edge inside the frame are cut by it
+_EDGE_MARGIN = 2.
+
+
+def _starts(length, tile_size, overlap):
+    """Window offsets along one axis, evenly spread so that neighbours
+    overlap by at least overlap of a window and the last one ends at the
+    frame edge"""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1. - overlap)))
+    count = int(np.ceil((length - tile_size) / float(stride))) + 1
+    return np.linspace(0, length - tile_size, count).round().astype(int).tolist()
+
+
+def tile_grid(height, width, tile_size, overlap=0.2):
+    """(y, x, h, w) windows covering a height x width frame"""
+    return [(y, x, min(tile_size, height), min(tile_size, width))
+            for y in _starts(height, tile_size, overlap)
+            for x in _starts(width, tile_size, overlap)]
+
+
+def letterbox(image, input_size, rgb=False):
+    """Scale image to fit input_size x input_size, centered on gray, as an
+    RGB uint8 frame.  Returns the frame and (scale, dy, dx) to map input
+    pixels back to the image."""
+    h, w = image.shape[:2]
+    scale = min(input_size / float(w), input_size / float(h))
+    nw, nh = max(1, int(scale * w)), max(1, int(scale * h))
+    dx, dy = (input_size - nw) // 2, (input_size - nh) // 2
+    frame = np.full((input_size, input_size, 3), _PAD, dtype=np.uint8)
+    frame[dy:dy + nh, dx:dx + nw] = cv2.resize(image, (nw, nh))
+    if not rgb:
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    return frame, (scale, dy, dx)
+
+
+class Tiler:
+    """Split frames into model-sized tiles and merge the tile predictions.
+
+    tile_size is the window side in frame pixels; set it to the model input
+    size to run windows at full resolution.  With full_frame, the whole
+    frame is added as a last tile, and boxes cut by a window edge inside the
+    frame are dropped in favour of that tile or a neighbouring window.
+    """
+    def __init__(self, tile_size, overlap=0.2, full_frame=True):
+        self.tile_size = int(tile_size)
+        self.overlap = min(max(float(overlap), 0.), 0.9)
+        self.full_frame = bool(full_frame)
+
+    def applies(self, cvImage):
+        """Whether the frame is larger than one window"""
+        return max(cvImage.shape[:2]) > self.tile_size
+
+    def split(self, cvImage, input_size, rgb=False):
+        """RGB uint8 tiles of input_size and a (tiles, 7) array of their
+        window (y, x, h, w) and letterbox (scale, dy, dx)"""
+        height, width = cvImage.shape[:2]
+        windows = tile_grid(height, width, self.tile_size, self.overlap)
+        if self.full_frame:
+            windows.append((0, 0, height, width))
+        tiles, geometry = [], []
+        for y, x, h, w in windows:
+            tile, placement = letterbox(cvImage[y:y + h, x:x + w], input_size, rgb)
+            tiles.append(tile)
+            geometry.append((y, x, h, w) + placement)
+        return tiles, np.asarray(geometry, dtype=np.float32)
+
+    def merge(self, pred, geometry, frame_shape, input_size):
+        """Map per-tile (x, y, w, h) boxes and scores, as the model outputs
+        them, to one batch of boxes in the frame scaled to input_size"""
+        box_xywh, scores = pred[0], pred[1]
+        if box_xywh.shape[0] != len(geometry) or scores.shape[0] != len(geometry):
+            raise ValueError('Expected predictions for {} tiles, got {} and {}'.format(
+                len(geometry), box_xywh.shape, scores.shape))
+        y0, x0, h, w, scale, dy, dx = [g[:, np.newaxis] for g in geometry.T]
+        # Input pixels -> frame pixels
+        cx = (box_xywh[..., 0] - dx) / scale + x0
+        cy = (box_xywh[..., 1] - dy) / scale + y0
+        bw = box_xywh[..., 2] / scale
+        bh = box_xywh[..., 3] / scale
+        if self.full_frame:
+            height, width = frame_shape[:2]
+            margin = _EDGE_MARGIN / scale
+            cut = (((cx - bw / 2. <= x0 + margin) & (x0 > 0)) |
+                   ((cy - bh / 2. <= y0 + margin) & (y0 > 0)) |
+                   ((cx + bw / 2. >= x0 + w - margin) & (x0 + w < width)) |
+                   ((cy + bh / 2. >= y0 + h - margin) & (y0 + h < height)))
+            # The full frame tile has no inner edges
+            cut[-1] = False
+            scores = np.where(cut[..., np.newaxis], 0., scores).astype(np.float32)
+        # Frame pixels -> the frame scaled to input_size x input_size
+        fx = input_size / float(frame_shape[1])
+        fy = input_size / float(frame_shape[0])
+        boxes = np.stack([cx * fx, cy * fy, bw * fx, bh * fy], axis=-1).astype(np.float32)
+        return [boxes.reshape(1, -1, 4), scores.reshape(1, -1, scores.shape[-1])]
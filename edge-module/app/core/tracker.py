@@ -0,0 +1,193 @@
+"""
+SORT-style multi-object tracker: a constant-velocity Kalman filter per
+track, vectorized over all tracks of a camera, and greedy IoU matching of
+predicted tracks to detections of the same class.
+
+Boxes are normalized (ymin, xmin, ymax, xmax) as returned by NMS.  The
+filter state is (cx, cy, aspect, height) and their velocities, with noise
+proportional to the box height so the same settings work at any scale.
+"""
+import collections
+import threading
+
+import numpy as np
+
+from core.postprocess import iou_matrix
+
+_STD_POSITION = 1. / 20
+_STD_VELOCITY = 1. / 160
+# Constant velocity over one frame
+_F = np.eye(8)
+_F[:4, 4:] = np.eye(4)
+
+
+def _to_xyah(boxes):
+    ymin, xmin, ymax, xmax = boxes.T
+    height = np.maximum(ymax - ymin, 1e-6)
+    return np.stack([(xmin + xmax) / 2., (ymin + ymax) / 2.,
+                     (xmax - xmin) / height, height], axis=-1)
+
+
+def _to_boxes(xyah):
+    cx, cy, aspect, height = xyah.T
+    width = aspect * height
+    return np.stack([cy - height / 2., cx - width / 2.,
+                     cy + height / 2., cx + width / 2.], axis=-1)
+
+
+def _diag(std):
+    """Batch of diagonal covariance matrices from per-track std rows"""
+    cov = np.zeros(std.shape + (std.shape[-1],))
+    idx = np.arange(std.shape[-1])
+    cov[:, idx, idx] = std ** 2
+    return cov
+
+
+class Tracker:
+    """Tracks of one camera.
+
+    step() advances every track by one frame; update() then matches the
+    frame's detections to the tracks, starts new tracks for the rest and
+    drops tracks that have not been matched for max_age frames.
+    """
+    def __init__(self, iou_threshold=0.3, max_age=30):
+        self.iou_threshold = float(iou_threshold)
+        self.max_age = int(max_age)
+        self.mean = np.zeros((0, 8))
+        self.cov = np.zeros((0, 8, 8))
+        self.ids = np.zeros((0,), dtype=np.int64)
+        self.classes = np.zeros((0,), dtype=np.float32)
+        self.scores = np.zeros((0,), dtype=np.float32)
+        # Frames since each track was last matched to a detection
+        self.age = np.zeros((0,), dtype=np.int64)
+        self.frames_since_detection = 0
+        self._next_id = 1
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def due(self, detect_every):
+        """Whether the next frame should go through the detector: every
+        detect_every frames, and whenever there is nothing to track or a
+        track is about to leave the frame"""
+        if self.frames_since_detection + 1 >= detect_every or len(self) == 0:
+            return True
+        center = (self.mean[:, :2] + self.mean[:, 4:6])
+        return bool(((center < 0.) | (center > 1.)).any())
+
+    def step(self):
+        """Predict every track one frame ahead"""
+        height = self.mean[:, 3]
+        std = np.stack([_STD_POSITION * height, _STD_POSITION * height,
+                        np.full_like(height, 1e-2), _STD_POSITION * height,
+                        _STD_VELOCITY * height, _STD_VELOCITY * height,
+                        np.full_like(height, 1e-5), _STD_VELOCITY * height], axis=-1)
+        self.mean = self.mean @ _F.T
+        self.cov = _F @ self.cov @ _F.T + _diag(std)
+        self.age += 1
+        self.frames_since_detection += 1
+
+    def predicted(self):
+        """Boxes, scores, classes and ids of the tracks matched by the last
+        detector run, at their predicted positions"""
+        live = self.age <= self.frames_since_detection
+        boxes = np.clip(_to_boxes(self.mean[live, :4]), 0., 1.).astype(np.float32)
+        return boxes, self.scores[live], self.classes[live], self.ids[live]
+
+    def update(self, boxes, scores, classes):
+        """Match a frame's detections to the tracks after step().  Returns
+        the track id of each detection."""
+        self.frames_since_detection = 0
+        track_ids = np.zeros(len(boxes), dtype=np.int64)
+        matched_tracks, matched_dets = self._match(boxes, classes)
+        if len(matched_tracks):
+            self._correct(matched_tracks, _to_xyah(boxes[matched_dets].astype(np.float64)))
+            self.age[matched_tracks] = 0
+            self.scores[matched_tracks] = scores[matched_dets]
+            track_ids[matched_dets] = self.ids[matched_tracks]
+
+        new = np.setdiff1d(np.arange(len(boxes)), matched_dets)
+        keep = self.age <= self.max_age
+        self.mean, self.cov = self.mean[keep], self.cov[keep]
+        self.ids, self.age = self.ids[keep], self.age[keep]
+        self.classes, self.scores = self.classes[keep], self.scores[keep]
+        if len(new):
+            track_ids[new] = self._start(boxes[new], scores[new], classes[new])
+        return track_ids
+
+    def _match(self, boxes, classes):
+        """Greedy matching by descending IoU between tracks and detections
+        of the same class"""
+        empty = np.zeros((0,), dtype=np.int64)
+        if len(self) == 0 or len(boxes) == 0:
+            return empty, empty
+        iou = iou_matrix(_to_boxes(self.mean[:, :4]), boxes.astype(np.float64))
+        iou[self.classes[:, None] != classes[None, :]] = 0.
+        tracks, dets = np.nonzero(iou >= self.iou_threshold)
+        order = np.argsort(-iou[tracks, dets], kind='stable')
+        used_tracks, used_dets = set(), set()
+        matched_tracks, matched_dets = [], []
+        for t, d in zip(tracks[order].tolist(), dets[order].tolist()):
+            if t in used_tracks or d in used_dets:
+                continue
+            used_tracks.add(t)
+            used_dets.add(d)
+            matched_tracks.append(t)
+            matched_dets.append(d)
+        return np.asarray(matched_tracks, dtype=np.int64), np.asarray(matched_dets, dtype=np.int64)
+
+    def _correct(self, idx, measurement):
+        """Kalman update of the tracks at idx with (cx, cy, aspect, height)"""
+        mean, cov = self.mean[idx], self.cov[idx]
+        height = mean[:, 3]
+        std = np.stack([_STD_POSITION * height, _STD_POSITION * height,
+                        np.full_like(height, 1e-1), _STD_POSITION * height], axis=-1)
+        innovation_cov = cov[:, :4, :4] + _diag(std)
+        gain = cov[:, :, :4] @ np.linalg.inv(innovation_cov)
+        innovation = measurement - mean[:, :4]
+        self.mean[idx] = mean + (gain @ innovation[..., np.newaxis])[..., 0]
+        self.cov[idx] = cov - gain @ innovation_cov @ np.transpose(gain, (0, 2, 1))
+
+    def _start(self, boxes, scores, classes):
+        xyah = _to_xyah(boxes.astype(np.float64))
+        height = xyah[:, 3]
+        std = np.stack([2 * _STD_POSITION * height, 2 * _STD_POSITION * height,
+                        np.full_like(height, 1e-2), 2 * _STD_POSITION * height,
+                        10 * _STD_VELOCITY * height, 10 * _STD_VELOCITY * height,
+                        np.full_like(height, 1e-5), 10 * _STD_VELOCITY * height], axis=-1)
+        ids = np.arange(self._next_id, self._next_id + len(boxes), dtype=np.int64)
+        self._next_id += len(boxes)
+        self.mean = np.concatenate([self.mean, np.hstack([xyah, np.zeros_like(xyah)])])
+        self.cov = np.concatenate([self.cov, _diag(std)])
+        self.ids = np.concatenate([self.ids, ids])
+        self.age = np.concatenate([self.age, np.zeros(len(boxes), dtype=np.int64)])
+        self.classes = np.concatenate([self.classes, classes.astype(np.float32)])
+        self.scores = np.concatenate([self.scores, scores.astype(np.float32)])
+        return ids
+
+
+class CameraTrackers:
+    """A Tracker per camera id, forgetting the least recently used camera
+    beyond max_cameras"""
+    def __init__(self, iou_threshold=0.3, max_age=30, max_cameras=256):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.max_cameras = int(max_cameras)
+        self._trackers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, camera):
+        with self._lock:
+            tracker = self._trackers.pop(camera, None)
+            if tracker is None:
+                tracker = Tracker(self.iou_threshold, self.max_age)
+            self._trackers[camera] = tracker
+            while len(self._trackers) > self.max_cameras:
+                self._trackers.popitem(last=False)
+            return tracker
+
+    def stats(self):
+        with self._lock:
+            return {'cameras': len(self._trackers),
+                    'tracks': sum(len(t) for t in self._trackers.values())}
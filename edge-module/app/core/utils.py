@@ -1,8 +1,8 @@
 import cv2
 import random
+import functools
 import colorsys
 import numpy as np
-import tensorflow as tf
 from core.config import cfg
 
 def load_freeze_layer(model='yolov4', tiny=False):
@@ -79,6 +79,11 @@ def read_class_names(class_file_name):
             names[ID] = name.strip('\n')
     return names
 
+@functools.lru_cache(maxsize=1)
+def default_class_names():
+    """Class names from the config, read on first use instead of at import"""
+    return read_class_names(cfg.YOLO.CLASSES)
+
 def load_config(FLAGS):
     if FLAGS.tiny:
         STRIDES = np.array(cfg.YOLO.STRIDES_TINY)
@@ -124,7 +129,9 @@ def image_preprocess(image, target_size, gt_boxes=None):
         gt_boxes[:, [1, 3]] = gt_boxes[:, [1, 3]] * scale + dh
         return image_paded, gt_boxes
 
-def draw_bbox(image, bboxes, classes=read_class_names(cfg.YOLO.CLASSES), show_label=True):
+def draw_bbox(image, bboxes, classes=None, show_label=True, bgr=False):
+    if classes is None:
+        classes = default_class_names()
     num_classes = len(classes)
     image_h, image_w, _ = image.shape
     hsv_tuples = [(1.0 * x / num_classes, 1., 1.) for x in range(num_classes)]
@@ -134,11 +141,14 @@ def draw_bbox(image, bboxes, classes=read_class_names(cfg.YOLO.CLASSES), show_la
     random.seed(0)
     random.shuffle(colors)
     random.seed(None)
+    if bgr:
+        # Same colors when drawing on a BGR (OpenCV ordered) image
+        colors = [color[::-1] for color in colors]
 
     out_boxes, out_scores, out_classes, num_boxes = bboxes
     for i in range(num_boxes[0]):
         if int(out_classes[0][i]) < 0 or int(out_classes[0][i]) > num_classes: continue
-        coor = out_boxes[0][i]
+        coor = np.array(out_boxes[0][i]) # copy so the caller's boxes are not scaled
         coor[0] = int(coor[0] * image_h)
         coor[2] = int(coor[2] * image_h)
         coor[1] = int(coor[1] * image_w)
@@ -149,16 +159,16 @@ def draw_bbox(image, bboxes, classes=read_class_names(cfg.YOLO.CLASSES), show_la
         class_ind = int(out_classes[0][i])
         bbox_color = colors[class_ind]
         bbox_thick = int(1.0 * (image_h + image_w) / 600)
-        c1, c2 = (coor[1], coor[0]), (coor[3], coor[2])
+        c1, c2 = (int(coor[1]), int(coor[0])), (int(coor[3]), int(coor[2]))
         cv2.rectangle(image, c1, c2, bbox_color, bbox_thick)
 
         if show_label:
             bbox_mess = '%s: %.2f' % (classes[class_ind], score)
             t_size = cv2.getTextSize(bbox_mess, 0, fontScale, thickness=bbox_thick // 2)[0]
             c3 = (c1[0] + t_size[0], c1[1] - t_size[1] - 3)
-            cv2.rectangle(image, c1, (np.float32(c3[0]), np.float32(c3[1])), bbox_color, -1) #filled
+            cv2.rectangle(image, c1, c3, bbox_color, -1) #filled
 
-            cv2.putText(image, bbox_mess, (c1[0], np.float32(c1[1] - 2)), cv2.FONT_HERSHEY_SIMPLEX,
+            cv2.putText(image, bbox_mess, (c1[0], c1[1] - 2), cv2.FONT_HERSHEY_SIMPLEX,
                         fontScale, (0, 0, 0), bbox_thick // 2, lineType=cv2.LINE_AA)
     return image
 
@@ -171,6 +181,8 @@ def bbox_iou(bboxes1, bboxes2):
     ex) (4,):(3,4) -> (3,)
         (2,1,4):(2,3,4) -> (2,3)
     """
+    # Imported here so that serving does not need TensorFlow
+    import tensorflow as tf
     bboxes1_area = bboxes1[..., 2] * bboxes1[..., 3]
     bboxes2_area = bboxes2[..., 2] * bboxes2[..., 3]
 
@@ -212,6 +224,7 @@ def bbox_giou(bboxes1, bboxes2):
     ex) (4,):(3,4) -> (3,)
         (2,1,4):(2,3,4) -> (2,3)
     """
+    import tensorflow as tf
     bboxes1_area = bboxes1[..., 2] * bboxes1[..., 3]
     bboxes2_area = bboxes2[..., 2] * bboxes2[..., 3]
 
@@ -263,6 +276,7 @@ def bbox_ciou(bboxes1, bboxes2):
     ex) (4,):(3,4) -> (3,)
         (2,1,4):(2,3,4) -> (2,3)
     """
+    import tensorflow as tf
     bboxes1_area = bboxes1[..., 2] * bboxes1[..., 3]
     bboxes2_area = bboxes2[..., 2] * bboxes2[..., 3]
 
@@ -325,49 +339,90 @@ def bbox_ciou(bboxes1, bboxes2):
 
     return ciou
 
+def _bbox_iou_np(bbox, bboxes):
+    """NumPy IoU of one (x, y, w, h) box against many, as in bbox_iou"""
+    area = bbox[2] * bbox[3]
+    areas = bboxes[:, 2] * bboxes[:, 3]
+    left_up = np.maximum(bbox[:2] - bbox[2:] * 0.5, bboxes[:, :2] - bboxes[:, 2:] * 0.5)
+    right_down = np.minimum(bbox[:2] + bbox[2:] * 0.5, bboxes[:, :2] + bboxes[:, 2:] * 0.5)
+    inter_section = np.maximum(right_down - left_up, 0.0)
+    inter_area = inter_section[:, 0] * inter_section[:, 1]
+    union_area = area + areas - inter_area
+    return np.divide(inter_area, union_area, out=np.zeros_like(inter_area),
+                     where=union_area != 0)
+
 def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     """
     :param bboxes: (xmin, ymin, xmax, ymax, score, class)
 
+    Boxes are compared with the same (x, y, w, h) convention as bbox_iou.
+    Returns the kept boxes grouped by class and in the order they were
+    picked; with 'soft-nms' the score column holds the decayed score.
+
     Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
           https://github.com/bharatsingh430/soft-nms
     """
+    assert method in ['nms', 'soft-nms']
+
     classes_in_img = list(set(bboxes[:, 5]))
+    class_ids = bboxes[:, 5]
+    coords = bboxes[:, :4]
     best_bboxes = []
 
-    for cls in classes_in_img:
-        cls_mask = (bboxes[:, 5] == cls)
-        cls_bboxes = bboxes[cls_mask]
-
-        while len(cls_bboxes) > 0:
-            max_ind = np.argmax(cls_bboxes[:, 4])
-            best_bbox = cls_bboxes[max_ind]
-            best_bboxes.append(best_bbox)
-            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
-            iou = bbox_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
-            weight = np.ones((len(iou),), dtype=np.float32)
-
-            assert method in ['nms', 'soft-nms']
-
-            if method == 'nms':
-                iou_mask = iou > iou_threshold
-                weight[iou_mask] = 0.0
+    if method == 'nms':
+        # Scores never change with hard NMS, so one sweep in descending score
+        # order covers every class; IoU is only taken against the
+        # remaining boxes of the kept box's class
+        order = np.argsort(-bboxes[:, 4], kind='stable')
+        members = {cls: order[class_ids[order] == cls] for cls in classes_in_img}
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        # Once a class has a pick, its boxes without a positive score are dropped
+        alive = bboxes[:, 4] > 0.
+        for cls in classes_in_img:
+            alive[members[cls][0]] = True
+
+        keep = {cls: [] for cls in classes_in_img}
+        for i in order:
+            if not alive[i]:
+                continue
+            cls = class_ids[i]
+            keep[cls].append(i)
+            rest = members[cls]
+            rest = rest[rank[rest] > rank[i]]
+            rest = rest[alive[rest]]
+            if len(rest):
+                iou = _bbox_iou_np(coords[i], coords[rest])
+                alive[rest[iou > iou_threshold]] = False
+        for cls in classes_in_img:
+            best_bboxes.extend(bboxes[keep[cls]])
+        return best_bboxes
 
-            if method == 'soft-nms':
-                weight = np.exp(-(1.0 * iou ** 2 / sigma))
-
-            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
-            score_mask = cls_bboxes[:, 4] > 0.
-            cls_bboxes = cls_bboxes[score_mask]
+    for cls in classes_in_img:
+        cls_bboxes = bboxes[class_ids == cls].copy()
+        cls_coords = cls_bboxes[:, :4]
+        scores = cls_bboxes[:, 4]
+        alive = np.ones(len(cls_bboxes), dtype=bool)
+        while alive.any():
+            # argmax picks the first of equal scores, as removing rows would
+            max_ind = np.argmax(np.where(alive, scores, -np.inf))
+            best_bboxes.append(cls_bboxes[max_ind].copy())
+            alive[max_ind] = False
+            rest = np.flatnonzero(alive)
+            iou = _bbox_iou_np(cls_coords[max_ind], cls_coords[rest])
+            scores[rest] = scores[rest] * np.exp(-(1.0 * iou ** 2 / sigma))
+            alive[rest] = scores[rest] > 0.
 
     return best_bboxes
 
 def freeze_all(model, frozen=True):
+    import tensorflow as tf
     model.trainable = not frozen
     if isinstance(model, tf.keras.Model):
         for l in model.layers:
             freeze_all(l, frozen)
 def unfreeze_all(model, frozen=False):
+    import tensorflow as tf
     model.trainable = not frozen
     if isinstance(model, tf.keras.Model):
         for l in model.layers:
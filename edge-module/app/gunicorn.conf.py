@@ -0,0 +1,53 @@
+import gc
+import os
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+# Worker threads let concurrent LVA requests reach the batching scheduler
+# instead of queueing behind a single synchronous worker
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# Import the app in the master before forking the workers, so they share
+# the pages of the Python modules, the TFLite runtime and the model file
+# instead of each loading its own.  Interpreters, threads and the storage
+# client cannot cross a fork and are built in each worker (post_worker_init).
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+if preload_app:
+    os.environ['MODEL_PRELOAD'] = '1'
+
+# Prometheus metrics are written per worker to files in this directory and
+# aggregated by /metrics.  It is set and created here, before the app (and
+# prometheus_client) is imported, and emptied so counters start from zero
+# with the server.
+multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus-multiproc')
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = multiproc_dir
+# Older prometheus_client releases only read the lower-case name
+os.environ['prometheus_multiproc_dir'] = multiproc_dir
+os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def on_starting(server):
+    for name in os.listdir(multiproc_dir):
+        if name.endswith('.db'):
+            os.remove(os.path.join(multiproc_dir, name))
+
+
+def when_ready(server):
+    # Keep the garbage collector of the workers from writing to (and so
+    # copying) the pages of objects preloaded in the master; Python 3.7+
+    if preload_app and hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    if preload_app:
+        sys.modules[worker.wsgi.import_name].init_worker()
+
+
+def child_exit(server, worker):
+    from core.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
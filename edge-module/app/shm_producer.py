@@ -0,0 +1,51 @@
+"""
+Send frames from an image or video file to the inference server through the
+shared memory transport (SHM_TRANSPORT_SOCKET) and print the detections.
+
+Usage:
+    python shm_producer.py --socket /tmp/yolo.sock --input video.mp4
+"""
+import argparse
+import time
+
+import cv2
+
+from core.shm_transport import ShmFrameClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared memory frame producer')
+    parser.add_argument('--socket', required=True, help='Unix socket of the server')
+    parser.add_argument('--shm', default='/dev/shm/yolov4-frames', help='Ring buffer file')
+    parser.add_argument('--input', required=True, help='Image or video file')
+    parser.add_argument('--slots', type=int, default=4, help='Number of ring buffer slots')
+    parser.add_argument('--camera', help='Camera id for class and region filters')
+    parser.add_argument('--max-frames', type=int, default=0, help='Stop after this many frames')
+    args = parser.parse_args()
+
+    capture = cv2.VideoCapture(args.input)
+    ok, frame = capture.read()
+    if not ok:
+        raise SystemExit('Could not read a frame from {}'.format(args.input))
+    height, width = frame.shape[:2]
+    client = ShmFrameClient(args.socket, args.shm, slot_count=args.slots,
+                            slot_size=frame.nbytes)
+    count = 0
+    try:
+        while ok:
+            start = time.time()
+            reply = client.score(frame, width, height, 'bgr24', timestamp=start,
+                                 camera=args.camera)
+            print({'frame': count,
+                   'latency_ms': round((time.time() - start) * 1000., 2),
+                   'reply': reply})
+            count += 1
+            if args.max_frames and count >= args.max_frames:
+                break
+            ok, frame = capture.read()
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+core.admission.AdmissionController: rejection, expiry and handing freed
+slots to waiting frames in arrival order.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core.admission as admission_module
+from core.admission import AdmissionController, Rejected, request_start
+
+
+class FakeTime:
+    """Stands in for the time module in core.admission, with a clock that
+    only moves when now is set"""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class Holder(threading.Thread):
+    """Takes a slot and keeps it until release is set, recording whether
+    it was admitted or the reason it was rejected"""
+    def __init__(self, admission, deadline=None, order=None, name=None):
+        super().__init__(daemon=True)
+        self.admission = admission
+        self.deadline = deadline
+        self.order = order
+        self.label = name
+        self.admitted = threading.Event()
+        self.release = threading.Event()
+        self.outcome = None
+
+    def run(self):
+        try:
+            with self.admission.slot(self.deadline):
+                self.outcome = 'admitted'
+                if self.order is not None:
+                    self.order.append(self.label)
+                self.admitted.set()
+                self.release.wait(5)
+        except Rejected as err:
+            self.outcome = err.reason
+
+
+def wait_for(condition, timeout=5.):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out')
+        time.sleep(0.005)
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def hold(self, admission, **kwargs):
+        holder = Holder(admission, **kwargs)
+        holder.start()
+        self.assertTrue(holder.admitted.wait(5))
+        return holder
+
+    def queue(self, admission, waiting, **kwargs):
+        holder = Holder(admission, **kwargs)
+        holder.start()
+        wait_for(lambda: admission.stats()['waiting'] == waiting)
+        return holder
+
+    def test_rejected_when_queue_full(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=1)
+        first = self.hold(admission)
+        second = self.queue(admission, 1)
+        with self.assertRaises(Rejected) as raised:
+            with admission.slot():
+                pass
+        self.assertEqual(raised.exception.reason, 'rejected')
+        first.release.set()
+        self.assertTrue(second.admitted.wait(5))
+        second.release.set()
+        second.join(5)
+        self.assertEqual(admission.stats(), {'admitted': 2, 'rejected': 1, 'expired': 0,
+                                             'in_flight': 0, 'waiting': 0})
+
+    def test_expired(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=4)
+        first = self.hold(admission)
+        start = time.time()
+        with self.assertRaises(Rejected) as raised:
+            with admission.slot(time.time() + 0.05):
+                pass
+        self.assertEqual(raised.exception.reason, 'expired')
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.assertEqual(admission.stats()['waiting'], 0)
+        first.release.set()
+        first.join(5)
+        self.assertEqual(admission.stats()['in_flight'], 0)
+
+    def test_free_slot_admitted_past_deadline(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=0)
+        with admission.slot(time.time() - 1.):
+            self.assertEqual(admission.stats()['in_flight'], 1)
+
+    def test_wakeup_not_lost_to_expired_waiter(self):
+        # The slot frees up after the first waiter's deadline has passed
+        # but before it has woken up to expire
+        clock = FakeTime(1000.)
+        with mock.patch.object(admission_module, 'time', clock):
+            admission = AdmissionController(max_in_flight=1, max_queue=4)
+            first = self.hold(admission)
+            late = self.queue(admission, 1, deadline=1001.)
+            patient = self.queue(admission, 2)
+            clock.now = 1002.
+            for holder in (first, late, patient):
+                holder.release.set()
+            for holder in (first, late, patient):
+                holder.join(5)
+        self.assertEqual((late.outcome, patient.outcome), ('admitted', 'admitted'))
+        stats = admission.stats()
+        self.assertEqual((stats['in_flight'], stats['waiting']), (0, 0))
+
+    def test_slot_handed_to_waiter_before_newcomer(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=1)
+        with admission.slot():
+            waiter = self.queue(admission, 1)
+        # The freed slot already belongs to the waiter, so a frame arriving
+        # right after the release has to wait behind it
+        self.assertEqual(admission.stats()['in_flight'], 1)
+        with self.assertRaises(Rejected) as raised:
+            with admission.slot(time.time() + 0.05):
+                pass
+        self.assertEqual(raised.exception.reason, 'expired')
+        self.assertTrue(waiter.admitted.wait(5))
+        waiter.release.set()
+        waiter.join(5)
+        self.assertEqual(admission.stats()['in_flight'], 0)
+
+    def test_arrival_order(self):
+        admission = AdmissionController(max_in_flight=1, max_queue=5)
+        order = []
+        first = self.hold(admission)
+        waiters = [self.queue(admission, i + 1, order=order, name=i) for i in range(5)]
+        for holder in waiters + [first]:
+            holder.release.set()
+        for holder in waiters:
+            holder.join(5)
+        self.assertEqual(order, list(range(5)))
+        self.assertEqual(admission.stats()['in_flight'], 0)
+
+
+class RequestStartTest(unittest.TestCase):
+
+    def test_nginx_header(self):
+        self.assertEqual(request_start('t=1000.250', now=1001.), 1000.25)
+
+    def test_missing_bad_or_skewed_header(self):
+        for header in (None, '', 't=abc', 't=2000', 't=100'):
+            self.assertEqual(request_start(header, now=1001.), 1001.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+core.batching.invoke_batch with stub interpreters: one that runs batches,
+one with a fixed batch dimension and one that, like the graph
+core.yolov4.decode_tflite builds, folds the batch into the box axis.
+"""
+import os
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.batching import BatchScheduler, invoke_batch
+
+BOXES = 6
+CLASSES = 3
+
+
+class StubModel:
+    def __init__(self):
+        self.batch_resizable = True
+
+
+class StubInterpreter:
+    """Boxes and scores of each frame are filled with its pixel value, so
+    a frame can tell whose predictions it got.  fold reshapes the outputs
+    to (1, -1, ...) as decode_tflite does; fixed refuses batches."""
+    def __init__(self, fold=False, fixed=False):
+        self.fold = fold
+        self.fixed = fixed
+        self.calls = []
+
+    def __call__(self, images):
+        self.calls.append(len(images))
+        if self.fixed and len(images) > 1:
+            raise ValueError('Cannot set tensor: Dimension mismatch')
+        values = np.array([image.flat[0] for image in images], dtype=np.float32)
+        boxes = np.broadcast_to(values[:, None, None], (len(images), BOXES, 4))
+        scores = np.broadcast_to(values[:, None, None], (len(images), BOXES, CLASSES))
+        if self.fold:
+            return [boxes.reshape(1, -1, 4), scores.reshape(1, -1, CLASSES)]
+        return [boxes.copy(), scores.copy()]
+
+
+def frames(count):
+    return [np.full((4, 4, 3), i + 1, dtype=np.uint8) for i in range(count)]
+
+
+class InvokeBatchTest(unittest.TestCase):
+
+    def check_outputs(self, images, outputs):
+        self.assertEqual(len(outputs), len(images))
+        for image, (boxes, scores) in zip(images, outputs):
+            self.assertEqual(boxes.shape, (1, BOXES, 4))
+            self.assertEqual(scores.shape, (1, BOXES, CLASSES))
+            self.assertTrue((boxes == image.flat[0]).all())
+            self.assertTrue((scores == image.flat[0]).all())
+
+    def test_batched(self):
+        model, invoke, images = StubModel(), StubInterpreter(), frames(4)
+        self.check_outputs(images, invoke_batch(invoke, images, model))
+        self.assertEqual(invoke.calls, [4])
+        self.assertTrue(model.batch_resizable)
+
+    def test_fixed_batch_dimension(self):
+        model, invoke, images = StubModel(), StubInterpreter(fixed=True), frames(3)
+        self.check_outputs(images, invoke_batch(invoke, images, model))
+        self.assertEqual(invoke.calls, [3, 1, 1, 1])
+        self.assertFalse(model.batch_resizable)
+
+    def test_folded_batch(self):
+        model, invoke, images = StubModel(), StubInterpreter(fold=True), frames(4)
+        self.check_outputs(images, invoke_batch(invoke, images, model))
+        self.assertEqual(invoke.calls, [4, 1, 1, 1, 1])
+        self.assertFalse(model.batch_resizable)
+        # Later batches go straight to one frame at a time
+        self.check_outputs(images, invoke_batch(invoke, images, model))
+        self.assertEqual(invoke.calls[5:], [1, 1, 1, 1])
+
+    def test_folded_batch_through_scheduler(self):
+        model, invoke = StubModel(), StubInterpreter(fold=True)
+        scheduler = BatchScheduler(lambda items: invoke_batch(invoke, items, model),
+                                   max_batch_size=4, max_wait_ms=50)
+        images = frames(4)
+        results = [None] * len(images)
+
+        def submit(i):
+            results[i] = scheduler.submit(images[i], timeout=5)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(images))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        scheduler.stop()
+        self.check_outputs(images, results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+core.utils.nms against the per-box loop it replaced, on seeded random
+boxes with tied and zero scores.
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.utils import nms
+
+
+def reference_bbox_iou(bboxes1, bboxes2):
+    """bbox_iou as it was, with NumPy in place of TensorFlow"""
+    bboxes1_area = bboxes1[..., 2] * bboxes1[..., 3]
+    bboxes2_area = bboxes2[..., 2] * bboxes2[..., 3]
+    bboxes1_coor = np.concatenate([bboxes1[..., :2] - bboxes1[..., 2:] * 0.5,
+                                   bboxes1[..., :2] + bboxes1[..., 2:] * 0.5], axis=-1)
+    bboxes2_coor = np.concatenate([bboxes2[..., :2] - bboxes2[..., 2:] * 0.5,
+                                   bboxes2[..., :2] + bboxes2[..., 2:] * 0.5], axis=-1)
+    left_up = np.maximum(bboxes1_coor[..., :2], bboxes2_coor[..., :2])
+    right_down = np.minimum(bboxes1_coor[..., 2:], bboxes2_coor[..., 2:])
+    inter_section = np.maximum(right_down - left_up, 0.0)
+    inter_area = inter_section[..., 0] * inter_section[..., 1]
+    union_area = bboxes1_area + bboxes2_area - inter_area
+    # tf.math.divide_no_nan
+    return np.divide(inter_area, union_area, out=np.zeros_like(inter_area),
+                     where=union_area != 0)
+
+
+def reference_nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
+    """The per-box loop nms used before it was vectorized"""
+    classes_in_img = list(set(bboxes[:, 5]))
+    best_bboxes = []
+
+    for cls in classes_in_img:
+        cls_mask = (bboxes[:, 5] == cls)
+        cls_bboxes = bboxes[cls_mask]
+
+        while len(cls_bboxes) > 0:
+            max_ind = np.argmax(cls_bboxes[:, 4])
+            best_bbox = cls_bboxes[max_ind]
+            best_bboxes.append(best_bbox)
+            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
+            iou = reference_bbox_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
+            weight = np.ones((len(iou),), dtype=np.float32)
+
+            assert method in ['nms', 'soft-nms']
+
+            if method == 'nms':
+                iou_mask = iou > iou_threshold
+                weight[iou_mask] = 0.0
+
+            if method == 'soft-nms':
+                weight = np.exp(-(1.0 * iou ** 2 / sigma))
+
+            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
+            score_mask = cls_bboxes[:, 4] > 0.
+            cls_bboxes = cls_bboxes[score_mask]
+
+    return best_bboxes
+
+
+def random_bboxes(rs, count, classes):
+    """(x, y, w, h, score, class) rows on a coarse grid, so that boxes
+    overlap heavily and repeat, with scores rounded to give ties and about
+    a fifth of them zero"""
+    centers = rs.randint(0, 20, size=(count, 2)) * 20.
+    sizes = rs.randint(1, 8, size=(count, 2)) * 20.
+    scores = np.round(rs.rand(count), 1)
+    scores[rs.rand(count) < 0.2] = 0.
+    class_ids = rs.randint(0, classes, size=count)
+    return np.column_stack([centers, sizes, scores, class_ids]).astype(np.float32)
+
+
+class NmsTest(unittest.TestCase):
+
+    def check(self, method):
+        rs = np.random.RandomState(0)
+        for case in range(150):
+            bboxes = random_bboxes(rs, rs.randint(1, 120), rs.randint(1, 5))
+            iou_threshold = rs.choice([0.3, 0.45, 0.6])
+            expected = reference_nms(bboxes.copy(), iou_threshold, method=method)
+            actual = nms(bboxes.copy(), iou_threshold, method=method)
+            self.assertEqual(len(actual), len(expected), 'case {}'.format(case))
+            if expected:
+                np.testing.assert_array_equal(np.stack(actual), np.stack(expected),
+                                              err_msg='case {}'.format(case))
+
+    def test_nms(self):
+        self.check('nms')
+
+    def test_soft_nms(self):
+        self.check('soft-nms')
+
+    def test_input_unchanged(self):
+        bboxes = random_bboxes(np.random.RandomState(1), 50, 3)
+        original = bboxes.copy()
+        nms(bboxes, 0.45, method='soft-nms')
+        nms(bboxes, 0.45)
+        np.testing.assert_array_equal(bboxes, original)
+
+
+if __name__ == '__main__':
+    unittest.main()
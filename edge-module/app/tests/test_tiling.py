@@ -0,0 +1,63 @@
+"""
+Tiled predictions from a stub interpreter that, like the graph
+core.yolov4.decode_tflite builds, folds the batch into the box axis.
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.batching import invoke_batch
+from core.tiling import Tiler
+
+INPUT_SIZE = 416
+BOXES = 5
+CLASSES = 2
+
+
+class StubModel:
+    def __init__(self):
+        self.batch_resizable = True
+
+
+def folded_invoke(tiles):
+    """One box per anchor in the middle of each tile, as (1, -1, ...)"""
+    boxes = np.tile(np.array([INPUT_SIZE / 2., INPUT_SIZE / 2., 40., 40.], dtype=np.float32),
+                    (len(tiles), BOXES, 1))
+    scores = np.full((len(tiles), BOXES, CLASSES), 0.9, dtype=np.float32)
+    return [boxes.reshape(1, -1, 4), scores.reshape(1, -1, CLASSES)]
+
+
+class TiledMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = np.zeros((900, 1600, 3), dtype=np.uint8)
+        self.tiler = Tiler(INPUT_SIZE, overlap=0.2, full_frame=True)
+        self.tiles, self.geometry = self.tiler.split(self.frame, INPUT_SIZE)
+
+    def test_merge_rejects_folded_batch(self):
+        with self.assertRaises(ValueError):
+            self.tiler.merge(folded_invoke(self.tiles), self.geometry, self.frame.shape,
+                             INPUT_SIZE)
+
+    def test_folded_batch_runs_per_tile(self):
+        model = StubModel()
+        preds = invoke_batch(folded_invoke, self.tiles, model)
+        pred = [np.concatenate(outputs, axis=0) for outputs in zip(*preds)]
+        boxes, scores = self.tiler.merge(pred, self.geometry, self.frame.shape, INPUT_SIZE)
+        self.assertFalse(model.batch_resizable)
+        self.assertEqual(boxes.shape, (1, len(self.tiles) * BOXES, 4))
+        self.assertEqual(scores.shape, (1, len(self.tiles) * BOXES, CLASSES))
+        # Each tile's boxes sit at the middle of its window, scaled to input_size
+        y, x, h, w = self.geometry[0, :4]
+        np.testing.assert_allclose(boxes[0, 0, :2],
+                                   [(x + w / 2.) * INPUT_SIZE / self.frame.shape[1],
+                                    (y + h / 2.) * INPUT_SIZE / self.frame.shape[0]],
+                                   rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
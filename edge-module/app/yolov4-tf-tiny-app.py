@@ -4,25 +4,46 @@
 App to run inference server for YOLO v4 TFLite model and send
 frames to Azure Blob IoT Edge module.
 """
-import core.utils as utils
-from core.yolov4 import filter_boxes
-
-import tensorflow as tf
-from tensorflow.compat.v1 import ConfigProto
-from tensorflow.compat.v1 import InteractiveSession
+import time
+# Reference point for the startup timing breakdown
+STARTUP_BEGIN = time.time()
+# When the gunicorn master finished importing and preloading, if it did
+PRELOAD_END = None
+
+import core.postprocess as postprocess
+import core.encoding as encoding
+import core.frames as frames
+import core.metrics as metrics
+import core.serialization as serialization
+from core.batching import BatchScheduler, invoke_batch
+from core.model_registry import ModelRegistry
+from core.blob_uploader import BlobUploader
+from core.dedup import FrameDeduplicator
+from core.shm_transport import ShmFrameServer
+from core.camera_config import load_camera_config
+from core.motion import MotionGate
+from core.adaptive import ResolutionController
+from core.admission import AdmissionController, Rejected, request_start
+from core.tiling import Tiler
+from core.tracker import CameraTrackers
+from core.interpreter_pool import load_interpreter_class, preload_model
+from core.memory import process_memory
+from core.model_registry import CURRENT_FILE, MODEL_FILE
+
+# TensorFlow is only imported for POSTPROCESS=tf or when tflite_runtime is
+# not installed, so serving can start without it
 
 import threading
-import io
+import functools
 import json
 import os
 import copy
-import time
 import datetime
 import base64
 import traceback
 import sys
+import hmac
 
-from PIL import Image
 import cv2
 import numpy as np
 from flask import Flask, request, jsonify, Response
@@ -48,27 +69,116 @@ FLAGS = dotdict({
     'tiny': True,
     'model': 'yolov4',
     'iou': 0.45,
-    'score': 0.25
+    'score': 0.25,
+    # Micro-batching of concurrent requests (a batch size of 1 disables it)
+    'batch_size': int(os.getenv('BATCH_MAX_SIZE', '1')),
+    'batch_wait_ms': float(os.getenv('BATCH_MAX_WAIT_MS', '5')),
+    # Interpreters that can run concurrently and threads used by each of them
+    'pool_size': int(os.getenv('INTERPRETER_POOL_SIZE', '1')),
+    'num_threads': int(os.getenv('INTERPRETER_NUM_THREADS', '0')) or None,
+    # Scale frames straight into the interpreter's input buffer
+    'zero_copy': os.getenv('PREPROCESS_ZERO_COPY', '1') == '1',
+    # Box filtering and NMS implementation: 'numpy' or 'tf' (eager TensorFlow)
+    'postprocess': os.getenv('POSTPROCESS', 'numpy'),
+    # Encoding of uploaded frames: 'cv2' or 'pil', JPEG quality and an
+    # optional maximum width to downscale to (0 keeps full resolution)
+    'jpeg_encoder': os.getenv('JPEG_ENCODER', 'cv2'),
+    'jpeg_quality': int(os.getenv('JPEG_QUALITY', '75')),
+    'jpeg_max_width': int(os.getenv('JPEG_MAX_WIDTH', '0')),
+    # Skip uploads within this many hash bits of the last stored frame with
+    # the same detected classes (negative disables deduplication)
+    'dedup_distance': int(os.getenv('DEDUP_MAX_DISTANCE', '-1')),
+    # Decode JPEGs at 1/2, 1/4 or 1/8 scale when still larger than the model
+    # input, re-decoding at full resolution for stored frames if requested
+    'reduced_decode': os.getenv('REDUCED_DECODE', '0') == '1',
+    'upload_full_resolution': os.getenv('UPLOAD_FULL_RESOLUTION', '1') == '1',
+    # Directory of versioned models that can be swapped in at runtime (unset
+    # serves 'weights' only), warm-up invocations per interpreter before a
+    # model serves, and how often to check the registry's CURRENT file
+    'model_registry': os.getenv('MODEL_REGISTRY_DIR', ''),
+    'warmup_runs': int(os.getenv('MODEL_WARMUP_RUNS', '3')),
+    'registry_poll_s': float(os.getenv('MODEL_REGISTRY_POLL_S', '5')),
+    # Interpreter implementation: 'auto' uses tflite_runtime when installed
+    # and falls back to TensorFlow, or force 'tflite_runtime' or 'tensorflow'
+    'tflite_backend': os.getenv('TFLITE_BACKEND', 'auto'),
+    # Emit confidences and boxes in /score JSON as numbers instead of strings
+    'numeric_response': os.getenv('RESPONSE_NUMERIC', '0') == '1',
+    # JSON file of per-camera class allowlists and regions of interest
+    'camera_config': os.getenv('CAMERA_CONFIG', ''),
+    # Reuse a camera's last detections while fewer than this fraction of the
+    # pixels of a small grayscale copy changed by more than the pixel delta,
+    # rescoring at least every refresh interval (negative disables the gate)
+    'motion_threshold': float(os.getenv('MOTION_THRESHOLD', '-1')),
+    'motion_pixel_delta': int(os.getenv('MOTION_PIXEL_DELTA', '15')),
+    'motion_refresh_s': float(os.getenv('MOTION_REFRESH_S', '10')),
+    # Run the detector on every Nth frame of a camera and move its tracked
+    # boxes in between; tracking also gives detections a trackingId
+    'detect_every': max(1, int(os.getenv('DETECT_EVERY_N', '1'))),
+    'tracking': os.getenv('TRACKING', '0') == '1' or int(os.getenv('DETECT_EVERY_N', '1')) > 1,
+    'track_iou_threshold': float(os.getenv('TRACK_IOU_THRESHOLD', '0.3')),
+    'track_max_age': int(os.getenv('TRACK_MAX_AGE', '30')),
+    # Score frames larger than this many pixels as overlapping tiles of that
+    # size, plus the whole frame unless TILE_FULL_FRAME=0 (0 disables tiling)
+    'tile_size': int(os.getenv('TILE_SIZE', '0')),
+    'tile_overlap': float(os.getenv('TILE_OVERLAP', '0.2')),
+    'tile_full_frame': os.getenv('TILE_FULL_FRAME', '1') == '1',
+    # Model input sizes to switch between to keep the p95 scoring latency
+    # under the target, e.g. 320,416,512 (empty disables), and the frames
+    # in flight that take the size one step further down (0 for the pool
+    # size times the batch size)
+    'adaptive_sizes': [int(s) for s in os.getenv('ADAPTIVE_SIZES', '').split(',') if s.strip()],
+    'latency_target_ms': float(os.getenv('LATENCY_TARGET_MS', '200')),
+    'adaptive_queue_depth': int(os.getenv('ADAPTIVE_QUEUE_DEPTH', '0')),
+    # Score at most this many /score frames at once (0 for the pool size
+    # times the batch size) with up to ADMISSION_MAX_QUEUE more waiting,
+    # answering 503 beyond that (negative disables admission control)
+    'admission_max_in_flight': int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '0')),
+    'admission_max_queue': int(os.getenv('ADMISSION_MAX_QUEUE', '-1')),
+    # Drop frames still waiting this long after they arrived, unless the
+    # request sets X-Deadline-Ms (0 for no deadline)
+    'deadline_ms': float(os.getenv('REQUEST_DEADLINE_MS', '0')),
+    'retry_after_s': int(os.getenv('RETRY_AFTER_S', '1'))
 })
 
+class ScoringError(Exception):
+    """A stage of scoring a frame failed; Score reports it as an inference"""
+
+
 class YoloV4TinyModel:
     def __init__(self):
         """Initialize class object"""
-        self._lock = threading.Lock()
-
+        init_begin = time.time()
         with open('./data/classes/coco.names', "r") as f:
             self._labelList = [l.rstrip() for l in f]
 
-        config = ConfigProto()
-        session = InteractiveSession(config=config)
-        STRIDES, ANCHORS, NUM_CLASS, XYSCALE = utils.load_config(FLAGS)
-
-        self.input_size = FLAGS.size
-
-        self.interpreter = tf.lite.Interpreter(model_path=FLAGS.weights)
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        # Per-thread uint8 buffers reused for resized frames
+        self._scratch = threading.local()
+
+        # Each model version has a pool of interpreters sharing one copy of
+        # the model, checked out per call.  New versions are warmed up and
+        # swapped in while requests in flight finish on the old one.  The
+        # adaptive mode adds interpreters resized to each of its input sizes.
+        sizes = [size for size in FLAGS.adaptive_sizes if size > 0 and size % 32 == 0]
+        if len(sizes) != len(FLAGS.adaptive_sizes):
+            print({'[WARNING]': 'Ignoring adaptive input sizes that are not multiples of 32: {}'.format(
+                sorted(set(FLAGS.adaptive_sizes) - set(sizes)))})
+        self.registry = ModelRegistry(FLAGS.model_registry, FLAGS.weights, self._labelList,
+                                      pool_size=FLAGS.pool_size,
+                                      num_threads=FLAGS.num_threads,
+                                      warmup_runs=FLAGS.warmup_runs,
+                                      setup=self._setup_model,
+                                      backend=FLAGS.tflite_backend,
+                                      sizes=sizes)
+        self.registry.watch(FLAGS.registry_poll_s)
+        self.resolution = None
+        if sizes:
+            with self.registry.active() as model:
+                sizes = [size for size in sizes if size in model.pools]
+            if sizes:
+                queue_depth = FLAGS.adaptive_queue_depth or FLAGS.pool_size * FLAGS.batch_size
+                self.resolution = ResolutionController(sizes, FLAGS.latency_target_ms,
+                                                       queue_depth=queue_depth)
+        model_ready = time.time()
 
         # Connect to local, edge Blob Storage
         self._local_account = os.getenv("LOCAL_STORAGE_ACCOUNT_NAME", "UNKNOWN_NAME")
@@ -83,18 +193,187 @@ class YoloV4TinyModel:
         self.blob_service_client = BlobServiceClient.from_connection_string(super_str,
             api_version='2019-07-07')
 
-    def Preprocess(self, cvImage):
+        # Frames are encoded and uploaded in the background from a bounded queue
+        self.uploader = BlobUploader(self.blob_service_client,
+            max_queue=int(os.getenv("UPLOAD_QUEUE_SIZE", "32")),
+            num_workers=int(os.getenv("UPLOAD_WORKERS", "2")),
+            max_retries=int(os.getenv("UPLOAD_MAX_RETRIES", "3")),
+            retry_backoff=float(os.getenv("UPLOAD_RETRY_BACKOFF_S", "0.5")),
+            drop_policy=os.getenv("UPLOAD_DROP_POLICY", "newest"))
+        self.uploader.ensure_containers([self.local_container_name_annotated,
+                                         self.local_container_name_lowconf])
+        self.dedup = None
+        if FLAGS.dedup_distance >= 0:
+            self.dedup = FrameDeduplicator(max_distance=FLAGS.dedup_distance)
+        # Class and region filters by camera id, applied before NMS
+        self.cameras = load_camera_config(FLAGS.camera_config) if FLAGS.camera_config else {}
+        self.motion = None
+        if FLAGS.motion_threshold >= 0:
+            self.motion = MotionGate(threshold=FLAGS.motion_threshold,
+                                     pixel_delta=FLAGS.motion_pixel_delta,
+                                     refresh_s=FLAGS.motion_refresh_s)
+        self.trackers = None
+        if FLAGS.tracking:
+            self.trackers = CameraTrackers(iou_threshold=FLAGS.track_iou_threshold,
+                                           max_age=FLAGS.track_max_age)
+        self.admission = None
+        if FLAGS.admission_max_queue >= 0:
+            self.admission = AdmissionController(
+                max_in_flight=FLAGS.admission_max_in_flight or FLAGS.pool_size * FLAGS.batch_size,
+                max_queue=FLAGS.admission_max_queue)
+        self.tiler = None
+        if FLAGS.tile_size > 0:
+            self.tiler = Tiler(FLAGS.tile_size, overlap=FLAGS.tile_overlap,
+                               full_frame=FLAGS.tile_full_frame)
+        storage_ready = time.time()
+
+        # Run one frame end to end (minus upload) before reporting ready
+        if FLAGS.warmup_runs:
+            self.WarmUp()
+        warm = time.time()
+        # Imports happened in the gunicorn master if it preloaded the app
+        imports_end = PRELOAD_END or init_begin
+        self.startup_times = {
+            'imports_s': round(imports_end - STARTUP_BEGIN, 3),
+            'model_load_s': round(model_ready - init_begin, 3),
+            'blob_storage_s': round(storage_ready - model_ready, 3),
+            'warmup_s': round(warm - storage_ready, 3),
+            'total_s': round(imports_end - STARTUP_BEGIN + warm - init_begin, 3),
+            'preloaded': PRELOAD_END is not None}
+        print({'[INFO]': 'Ready to score with model {} in {}s: {}, memory (MB) of pid {}: {}'.format(
+            self.registry.active_version, self.startup_times['total_s'], self.startup_times,
+            os.getpid(), process_memory())})
+
+    def _setup_model(self, model):
+        """Frames from concurrent requests are grouped and run with one
+        invoke(), with one scheduler worker per pooled interpreter and a
+        scheduler per input size"""
+        if FLAGS.batch_size > 1:
+            for input_size, pool in model.pools.items():
+                model.schedulers[input_size] = BatchScheduler(
+                    functools.partial(self._run_batch, model, input_size),
+                    max_batch_size=FLAGS.batch_size,
+                    max_wait_ms=FLAGS.batch_wait_ms,
+                    num_workers=pool.size)
+
+    def Preprocess(self, cvImage, rgb=False, input_size=None):
         """Preprocess cv2/opencv formatted image: convert to RGB, resize, 
-        normalize, expand dimensions and convert to uint8 for quantized tflite model.
+        normalize and expand dimensions for a float tflite model (quantized
+        models take PreprocessFrame output).
         """
-        imageBlob = cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
-        imageBlob = cv2.resize(imageBlob, (self.input_size, self.input_size))
+        input_size = input_size or FLAGS.size
+        imageBlob = cvImage if rgb else cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
+        imageBlob = cv2.resize(imageBlob, (input_size, input_size))
         imageBlob = imageBlob / 255. # normalize
         imageBlob = imageBlob[np.newaxis, ...].astype(np.float32) # batch size 1
         return imageBlob
 
-    def Postprocess(self, boxes, scores, indices):
+    def PreprocessFrame(self, cvImage, rgb=False, input_size=None):
+        """Resize cv2/opencv formatted image and convert to RGB into a reused
+        uint8 buffer.  Normalization happens when the frame is written into
+        the interpreter's input tensor, so no float copy is made here.
+        """
+        input_size = input_size or FLAGS.size
+        frame = getattr(self._scratch, 'frame', None)
+        if frame is None or frame.shape[0] != input_size:
+            frame = np.empty((input_size, input_size, 3), dtype=np.uint8)
+            self._scratch.frame = frame
+        # Resizing first means the channel swap only touches the small frame
+        cv2.resize(cvImage, (input_size, input_size), dst=frame)
+        if not rgb:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        return frame
+
+    def _run_batch(self, model, input_size, images):
+        """Invoke the interpreter once for frames collected by the scheduler
+        and split the outputs back into per-frame predictions."""
+        with model.pools[input_size].checkout() as runner:
+            return invoke_batch(functools.partial(self._invoke, runner), images, model)
+
+    def _run_tiles(self, model, input_size, tiles):
+        """Invoke the interpreter once for all tiles of a frame, or once per
+        tile if the model cannot run them as a batch, and concatenate the
+        outputs."""
+        pool = model.pools[input_size]
+        images = tiles if self._takes_frames(pool) else \
+            [tile[np.newaxis].astype(np.float32) / 255. for tile in tiles]
+        with pool.checkout() as runner:
+            preds = invoke_batch(functools.partial(self._invoke, runner), images, model)
+        return [np.concatenate(outputs, axis=0) for outputs in zip(*preds)]
+
+    def _takes_frames(self, pool):
+        """Whether frames for pool go through PreprocessFrame: always for
+        quantized models, which take the uint8 pixels without normalizing"""
+        return FLAGS.zero_copy or pool.quantized
+
+    def _invoke(self, runner, images):
+        """Run images from Preprocess or PreprocessFrame on a pooled interpreter"""
+        if images[0].dtype == np.uint8:
+            return runner.invoke_frames(images)
+        return runner.invoke(np.concatenate(images, axis=0))
+
+    def _render_jpeg(self, cvImage, pred_bbox=None, rgb=False, labels=None):
+        """Encode a frame for upload with the configured encoder, quality
+        and size, annotating it if bounding boxes are given."""
+        return encoding.render_jpeg(cvImage, pred_bbox, rgb=rgb, classes=labels,
+                                    encoder=FLAGS.jpeg_encoder,
+                                    quality=FLAGS.jpeg_quality,
+                                    max_width=FLAGS.jpeg_max_width)
+
+    def Camera(self, camera_id=None):
+        """Filter for a camera id, else the 'default' entry or None"""
+        camera = self.cameras.get(camera_id) if camera_id is not None else None
+        return camera if camera is not None else self.cameras.get('default')
+
+    def WarmUp(self):
+        """Score a blank frame without storing it, so that the first request
+        does not pay for one-off allocations in preprocessing and NMS"""
+        frame = np.zeros((FLAGS.size, FLAGS.size, 3), dtype=np.uint8)
+        with self.registry.active() as model:
+            if self._takes_frames(model.pool):
+                image_data = self.PreprocessFrame(frame, input_size=model.input_size)
+            else:
+                image_data = self.Preprocess(frame, input_size=model.input_size)
+            with model.pool.checkout() as runner:
+                pred = self._invoke(runner, [image_data])
+        self._nms(pred, model.input_size)
+
+    def _nms(self, pred, input_size, camera=None, labels=None):
+        """Filter boxes by score and run non-max suppression on the model
+        outputs, returning boxes, scores, classes and valid detections.
+        A camera filter drops classes and regions before NMS sees them."""
+        pred_scores = pred[1]
+        if camera is not None:
+            pred_scores = camera.filter_scores(pred[0], pred_scores, input_size, labels)
+        if FLAGS.postprocess == 'numpy':
+            boxes, pred_conf = postprocess.filter_boxes(pred[0], pred_scores, score_threshold=0.25,
+                                                        input_shape=(input_size,
+                                                                     input_size))
+            return postprocess.combined_non_max_suppression(
+                boxes=boxes,
+                scores=pred_conf,
+                max_output_size_per_class=50,
+                max_total_size=50,
+                iou_threshold=FLAGS.iou,
+                score_threshold=FLAGS.score)
+        import tensorflow as tf
+        from core.yolov4 import filter_boxes
+        boxes, pred_conf = filter_boxes(pred[0], pred_scores, score_threshold=0.25,
+                                        input_shape=tf.constant([input_size,
+                                                                input_size]))
+        nmsed = tf.image.combined_non_max_suppression(
+            boxes=tf.reshape(boxes, (tf.shape(boxes)[0], -1, 1, 4)),
+            scores=tf.reshape(
+                pred_conf, (tf.shape(pred_conf)[0], -1, tf.shape(pred_conf)[-1])),
+            max_output_size_per_class=50,
+            max_total_size=50,
+            iou_threshold=FLAGS.iou,
+            score_threshold=FLAGS.score)
+        return [t.numpy() for t in nmsed]
+
+    def Postprocess(self, boxes, scores, indices, labels=None, track_ids=None):
         detectedObjects = []
+        labels = labels or self._labelList
 
         if len(indices) > 0:
             for i in range(len(indices)):
@@ -106,7 +385,7 @@ class YoloV4TinyModel:
                         "type" : "entity",
                         "entity" : {
                             "tag" : {
-                                "value" : self._labelList[idx],
+                                "value" : labels[idx],
                                 "confidence" : str(scores[i])
                             },
                             "box" : {
@@ -117,126 +396,195 @@ class YoloV4TinyModel:
                             }
                         }
                     }
+                    if track_ids is not None:
+                        dobj["entity"]["trackingId"] = str(track_ids[i])
 
                     detectedObjects.append(dobj)
 
         return detectedObjects
 
-    def Score(self, cvImage):
+    def _results(self, boxes, scores, indices, labels, raw, track_ids=None, input_size=None):
+        """Detections above the score threshold as Score returns them"""
+        if raw:
+            return serialization.Detections(boxes, scores, indices, labels, track_ids,
+                                            input_size)
+        return self.Postprocess(boxes, scores, indices, labels, track_ids)
+
+    def Score(self, cvImage, rgb=False, full_frame=None, borrowed=False, raw=False,
+              camera=None):
         """Use tflite interpreter to predict bounding boxes and 
-        confidence score."""
-        with self._lock:
-            timestamp = datetime.datetime.now()
-            # Predict
-            try:
-                image_data = self.Preprocess(cvImage)
-                self.interpreter.set_tensor(self.input_details[0]['index'], image_data)
-                self.interpreter.invoke()
-                pred = [self.interpreter.get_tensor(
-                    self.output_details[i]['index']) for i in range(len(self.output_details))]
-            except Exception as err:
-                return [{'[ERROR]': 'Error during prediciton: {}'.format(repr(err))}]
-
-            # Filter and NMS
-            try:
-                boxes, pred_conf = filter_boxes(pred[0], pred[1], score_threshold=0.25,
-                                                    input_shape=tf.constant([self.input_size,
-                                                                            self.input_size]))
-                boxes, scores, indices, valid_detections = tf.image.combined_non_max_suppression(
-                    boxes=tf.reshape(boxes, (tf.shape(boxes)[0], -1, 1, 4)),
-                    scores=tf.reshape(
-                        pred_conf, (tf.shape(pred_conf)[0], -1, tf.shape(pred_conf)[-1])),
-                    max_output_size_per_class=50,
-                    max_total_size=50,
-                    iou_threshold=FLAGS.iou,
-                    score_threshold=FLAGS.score)
-            except Exception as err:
-                return [{'[ERROR]': 'Error during filter and NMS: {}'.format(repr(err))}]
-
-            try:
-                # Save image w/ annotations to Blob Storage (through IoT module 
-                # and then to cloud Azure Storage pending connectivity)
-                pred_bbox = [boxes.numpy(),
-                             scores.numpy(),
-                             indices.numpy(),
-                             valid_detections.numpy()]
-                image = cv2.cvtColor(cvImage, cv2.COLOR_BGR2RGB)
-                image_annot = utils.draw_bbox(image, pred_bbox)
-                #image = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB)
-
-                pil_image = Image.fromarray(image_annot.astype(np.uint8))
-                # Save annotaed image to buffer
-                bytes_io_annot = io.BytesIO()
-                pil_image.save(bytes_io_annot, format='JPEG')
-                bytes_im_annot = bytes_io_annot.getvalue()
-
-                # Unannotated image to buffer
-                pil_image = Image.fromarray(image.astype(np.uint8))
-                bytes_io_unannot = io.BytesIO()
-                pil_image.save(bytes_io_unannot, format='JPEG')
-                bytes_im_unannot = bytes_io_unannot.getvalue()
-
-                # To check if there are bboxes
-                indices_check = np.squeeze(indices.numpy(), axis=0)
-                scores_check = np.squeeze(scores.numpy(), axis=0)
-                if scores_check.any() > FLAGS.score:
-                    # Name in blob to use
-                    blob_name = str(timestamp.strftime(
-                        "%d-%b-%Y-%H-%M-%S.%f")) +"_annotated.jpg"
-                    blob_metadata = {'timestamp': str(timestamp.strftime("%d-%b-%Y-%H-%M-%S.%f")),
-                            'objects': ','.join(set([self._labelList[int(indices_check[i])] for i in range(
-                                len(indices_check)) if scores_check[i] > FLAGS.score]))}
-                    try:
-                        container_client = self.blob_service_client.get_container_client(
-                            self.local_container_name_annotated)
-                        props = container_client.get_container_properties()
-                    except Exception as err:
-                        # Local container needs to be created if not
-                        container_client.create_container()
-                    # Upload pil image as buffer
-                    container_client.upload_blob(blob_name, bytes_im_annot, metadata=blob_metadata)
+        confidence score.  Frames are BGR unless rgb is set.  If cvImage was
+        decoded at reduced size, full_frame returns the full resolution frame
+        for upload.  A borrowed frame (e.g. in a shared memory slot) is only
+        valid until Score returns, so it is copied if it is going to be stored.
+        With raw set, detections are returned as serialization.Detections
+        arrays instead of LVA inference dicts; errors are always dicts.
+        camera is the id of the camera the frame comes from, which selects
+        its filters, motion gate and tracks.  With tracking on, frames
+        between detector runs get the camera's tracked boxes moved to
+        where they are predicted to be, without inference or upload.
+        Frames that reach the detector are scored at the input size the
+        adaptive mode picks if it is on."""
+        # An unchanged frame gets the camera's last result without being scored
+        motion_key = (camera, raw)
+        thumbnail = None
+        if self.motion is not None:
+            cached, thumbnail = self.motion.check(motion_key, cvImage, rgb)
+            if cached is not None:
+                metrics.FRAMES.labels('unchanged').inc()
+                return cached
+        tracker = self.trackers.get(camera) if self.trackers is not None else None
+        if tracker is not None:
+            with tracker.lock:
+                detect = tracker.due(FLAGS.detect_every)
+                tracker.step()
+                if not detect:
+                    boxes, scores, indices, track_ids = tracker.predicted()
+            if not detect:
+                with self.registry.active() as model:
+                    labels = model.labels
+                metrics.FRAMES.labels('tracked').inc()
+                return self._results(boxes, scores, indices, labels, raw, track_ids)
+        # Only frames that run the detector count towards the adaptive
+        # mode's latencies, and failed ones are left out
+        try:
+            if self.resolution is None:
+                return self._detect(cvImage, rgb, full_frame, borrowed, raw, camera,
+                                    tracker, thumbnail)
+            with self.resolution.choose() as input_size:
+                return self._detect(cvImage, rgb, full_frame, borrowed, raw, camera,
+                                    tracker, thumbnail, input_size)
+        except ScoringError as err:
+            metrics.FRAMES.labels('error').inc()
+            return [{'[ERROR]': str(err)}]
+
+    def _detect(self, cvImage, rgb, full_frame, borrowed, raw, camera, tracker, thumbnail,
+                input_size=None):
+        """Run the detector on a frame for Score, updating the camera's
+        tracks and motion gate.  input_size picks one of the model's
+        interpreter pools, defaulting to the model's own input size.
+        Raises ScoringError if a stage fails."""
+        timestamp = datetime.datetime.now()
+        camera_filter = self.Camera(camera)
+        # Predict on the model version that is active when the frame arrives
+        try:
+            with self.registry.active() as model:
+                if input_size not in model.pools:
+                    input_size = model.input_size
+                geometry = None
+                if self.tiler is not None and self.tiler.applies(cvImage):
+                    # Large frames are scored as one batch of tiles, bypassing
+                    # the batch scheduler
+                    with metrics.timed('preprocess'):
+                        tiles, geometry = self.tiler.split(cvImage, input_size, rgb)
+                    with metrics.timed('invoke'):
+                        pred = self._run_tiles(model, input_size, tiles)
+                else:
+                    with metrics.timed('preprocess'):
+                        if self._takes_frames(model.pools[input_size]):
+                            image_data = self.PreprocessFrame(cvImage, rgb, input_size)
+                        else:
+                            image_data = self.Preprocess(cvImage, rgb, input_size)
+                    with metrics.timed('invoke'):
+                        scheduler = model.schedulers.get(input_size)
+                        if scheduler is not None:
+                            pred = scheduler.submit(image_data)
+                        else:
+                            with model.pools[input_size].checkout() as runner:
+                                pred = self._invoke(runner, [image_data])
+        except Exception as err:
+            raise ScoringError('Error during prediciton: {}'.format(repr(err)))
+
+        # Filter and NMS
+        try:
+            with metrics.timed('nms'):
+                if geometry is not None:
+                    pred = self.tiler.merge(pred, geometry, cvImage.shape, input_size)
+                boxes, scores, indices, valid_detections = self._nms(pred, input_size, camera_filter,
+                                                                     model.labels)
+        except Exception as err:
+            raise ScoringError('Error during filter and NMS: {}'.format(repr(err)))
+
+        try:
+            # Save image w/ annotations to Blob Storage (through IoT module 
+            # and then to cloud Azure Storage pending connectivity).  Encoding
+            # and upload happen on the uploader's threads.
+            pred_bbox = [boxes, scores, indices, valid_detections]
+
+            # Only the frame that is stored gets rendered and encoded: the
+            # annotated frame if any box passed the threshold, else the raw one
+            indices_check = np.squeeze(indices, axis=0)
+            scores_check = np.squeeze(scores, axis=0)
+            passed = scores_check > FLAGS.score
+            for idx in indices_check[passed]:
+                metrics.DETECTIONS.labels(model.labels[int(idx)]).inc()
+            timestamp_str = str(timestamp.strftime("%d-%b-%Y-%H-%M-%S.%f"))
+            upload_frame = full_frame if full_frame is not None else lambda: cvImage
+            if passed.any():
+                container_name = self.local_container_name_annotated
+                # Name in blob to use
+                blob_name = timestamp_str + "_annotated.jpg"
+                objects = set([model.labels[int(idx)] for idx in indices_check[passed]])
+                render = lambda: self._render_jpeg(upload_frame(), pred_bbox, rgb, model.labels)
+            else:
                 # If all scores are below threshold let's store the frames for later use
-                if scores_check.all() < FLAGS.score:
-                    # Name in blob to use
-                    blob_name = str(timestamp.strftime(
-                        "%d-%b-%Y-%H-%M-%S.%f")) +"_lowconf.jpg"
-                    blob_metadata = {'timestamp': str(timestamp.strftime("%d-%b-%Y-%H-%M-%S.%f")),
-                            'objects': ','.join(set([self._labelList[int(indices_check[i])] for i in range(
-                                len(indices_check))]))}
-                    try:
-                        container_client = self.blob_service_client.get_container_client(
-                            self.local_container_name_lowconf)
-                        props = container_client.get_container_properties()
-                    except Exception as err:
-                        # Local container needs to be created if not
-                        container_client.create_container()
-                    # Upload pil image as buffer
-                    container_client.upload_blob(blob_name, bytes_im_unannot, metadata=blob_metadata)
-            except Exception as err:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                return [{'[ERROR]': 
-                    'Error sending image to local blob storage: {}'.format(
-                     repr(traceback.format_exception(
-                         exc_type,
-                         exc_value,
-                         exc_traceback)))}]
-
-            # Postprocess
-            try:
-                boxes = np.squeeze(boxes.numpy(), axis=0)
-                scores = np.squeeze(scores.numpy(), axis=0)
-                indices = np.squeeze(indices.numpy(), axis=0)
-                results = self.Postprocess(boxes, scores, indices)
-            except Exception as err:
-                return [{'[ERROR]': 'Error during postprocess: {}'.format(repr(err))}]
-
+                container_name = self.local_container_name_lowconf
+                blob_name = timestamp_str + "_lowconf.jpg"
+                objects = set()
+                render = lambda: self._render_jpeg(upload_frame(), rgb=rgb)
+            store = passed.any() or camera_filter is None or camera_filter.store_lowconf
+            if store and (self.dedup is None or
+                          not self.dedup.is_duplicate(container_name, cvImage, objects)):
+                if borrowed and full_frame is None:
+                    stored_frame = cvImage.copy()
+                    upload_frame = lambda: stored_frame
+                blob_metadata = {'timestamp': timestamp_str, 'objects': ','.join(objects)}
+                if camera is not None:
+                    blob_metadata['camera'] = camera
+                self.uploader.submit(container_name, blob_name, render, metadata=blob_metadata)
+        except Exception as err:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            raise ScoringError(
+                'Error queueing image for local blob storage: {}'.format(
+                 repr(traceback.format_exception(
+                     exc_type,
+                     exc_value,
+                     exc_traceback))))
+
+        # Postprocess
+        try:
+            scores = np.squeeze(scores, axis=0)
+            keep = scores > FLAGS.score
+            boxes = np.squeeze(boxes, axis=0)[keep]
+            indices = np.squeeze(indices, axis=0)[keep]
+            scores = scores[keep]
+            track_ids = None
+            if tracker is not None:
+                with tracker.lock:
+                    track_ids = tracker.update(boxes, scores, indices)
+            results = self._results(boxes, scores, indices, model.labels, raw, track_ids,
+                                    input_size)
+        except Exception as err:
+            raise ScoringError('Error during postprocess: {}'.format(repr(err)))
+
+        if self.motion is not None:
+            self.motion.update((camera, raw), thumbnail, results)
+        metrics.FRAMES.labels('scored').inc()
         return results
 
-# global ml model class
-yolo = YoloV4TinyModel()
+# global ml model class, built by init_worker
+yolo = None
+shm_server = None
+_init_lock = threading.Lock()
 
 app = Flask(__name__)
 
+@app.before_request
+def ensure_model():
+    # Normally built at import or by gunicorn's post_worker_init already
+    if yolo is None:
+        init_worker()
+
 # / routes to the default function which returns 'Hello World'
 @app.route('/', methods=['GET'])
 def defaultPage():
@@ -246,36 +594,189 @@ def defaultPage():
 # This function returns a JSON object with inference duration and detected objects
 @app.route('/score', methods=['POST'])
 def score():
+    global yolo
+    if yolo.admission is None:
+        return score_request()
+    # Shed load: frames beyond the admission queue, or whose deadline passes
+    # while they wait (counted from when nginx received them), get a 503
+    try:
+        deadline_ms = float(request.headers.get('X-Deadline-Ms', FLAGS.deadline_ms))
+    except ValueError:
+        deadline_ms = FLAGS.deadline_ms
+    deadline = None
+    if deadline_ms > 0:
+        deadline = request_start(request.headers.get('X-Request-Start')) + deadline_ms / 1000.
+    try:
+        with yolo.admission.slot(deadline):
+            return score_request()
+    except Rejected as err:
+        metrics.FRAMES.labels(err.reason).inc()
+        return Response(response='[ERROR] {}'.format(err), status=503,
+                        headers={'Retry-After': str(FLAGS.retry_after_s)})
+
+def score_request():
     global yolo
     try:
         # get request as byte stream
         reqBody = request.get_data(False)
 
-        # convert from byte stream
-        inMemFile = io.BytesIO(reqBody)
-
-        # load a sample image
-        inMemFile.seek(0)
-        fileBytes = np.asarray(bytearray(inMemFile.read()), dtype=np.uint8)
-
-        cvImage = cv2.imdecode(fileBytes, cv2.IMREAD_COLOR)
+        # Raw frames give their size and pixel format (bgr24, rgb24 or nv12)
+        # as query parameters or headers, anything else is decoded as an image
+        pixel_format = request.args.get('pixel_format', request.headers.get('X-Pixel-Format'))
+        full_frame = None
+        try:
+            with metrics.timed('decode'):
+                if pixel_format:
+                    width = int(request.args.get('width', request.headers.get('X-Frame-Width', 0)))
+                    height = int(request.args.get('height', request.headers.get('X-Frame-Height', 0)))
+                    cvImage, rgb = frames.decode_raw(reqBody, width, height, pixel_format)
+                else:
+                    # Large JPEGs can be decoded straight to a smaller size since
+                    # the model only sees FLAGS.size pixels; boxes are normalized
+                    factor = frames.reduction_factor(reqBody, FLAGS.size) if FLAGS.reduced_decode else 1
+                    cvImage, rgb = frames.decode_image(reqBody, factor), False
+                    if factor > 1 and FLAGS.upload_full_resolution:
+                        full_frame = lambda: frames.decode_image(reqBody)
+        except ValueError as err:
+            metrics.FRAMES.labels('bad_frame').inc()
+            return Response(response='[ERROR] Bad frame in score : {}'.format(repr(err)), status=400)
+
+        # Class and region filters and motion gating for the camera named in the request
+        camera = request.args.get('camera', request.headers.get('X-Camera-Id'))
 
         # Infer Image
-        detectedObjects = yolo.Score(cvImage)
+        detectedObjects = yolo.Score(cvImage, rgb, full_frame, raw=True, camera=camera)
 
-        if len(detectedObjects) > 0:
+        if isinstance(detectedObjects, list):
+            # Errors are reported as inferences
             respBody = {                    
                         "inferences" : detectedObjects
                     }
 
             respBody = json.dumps(respBody)
             return Response(respBody, status= 200, mimetype ='application/json')
+
+        # Input size the frame was scored at, which varies in the adaptive mode
+        headers = {}
+        if detectedObjects.input_size is not None:
+            headers['X-Input-Size'] = str(detectedObjects.input_size)
+        if len(detectedObjects) > 0:
+            # JSON in the LVA format unless a binary format is asked for
+            mimetype = request.accept_mimetypes.best_match(serialization.MIMETYPES,
+                                                           default=serialization.JSON)
+            respBody = serialization.serialize(detectedObjects, mimetype,
+                                               numeric=FLAGS.numeric_response)
+            return Response(respBody, status= 200, mimetype=mimetype, headers=headers)
         else:
-            return Response(status= 204)
+            return Response(status= 204, headers=headers)
 
     except Exception as err:
         return Response(response='[ERROR] Exception in score : {}'.format(repr(err)), status=500)
 
+# /stats returns counters for the background blob uploader, deduplication and
+# the motion gate, tracking, the adaptive input size and admission control,
+# and the startup timings
+@app.route('/stats', methods=['GET'])
+def stats():
+    global yolo
+    stats = {'uploads': yolo.uploader.stats(), 'startup': yolo.startup_times,
+             'memory': dict(process_memory(), pid=os.getpid())}
+    if yolo.dedup is not None:
+        stats['dedup'] = yolo.dedup.stats()
+    if yolo.motion is not None:
+        stats['motion'] = yolo.motion.stats()
+    if yolo.trackers is not None:
+        stats['tracking'] = yolo.trackers.stats()
+    if yolo.resolution is not None:
+        stats['adaptive'] = yolo.resolution.stats()
+    if yolo.admission is not None:
+        stats['admission'] = yolo.admission.stats()
+    return jsonify(stats)
+
+# /metrics exposes stage latencies and counters in the Prometheus text
+# format, aggregated across gunicorn workers
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if not metrics.enabled:
+        return Response(response='[ERROR] prometheus_client is not installed', status=501)
+    body, content_type = metrics.render()
+    return Response(body, status=200, mimetype=content_type)
+
+# /models lists the versions in the model registry and the one serving.
+# POST /models/<version>/activate loads and warms up a version in the
+# background and then swaps it in; poll /models for the outcome.  If
+# MODEL_ADMIN_TOKEN is set it has to be sent in an X-Admin-Token header.
+def _admin_allowed():
+    token = os.getenv("MODEL_ADMIN_TOKEN")
+    return not token or hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+@app.route('/models', methods=['GET'])
+def models():
+    global yolo
+    if not _admin_allowed():
+        return Response(response='[ERROR] Not authorized', status=401)
+    return jsonify(yolo.registry.status())
+
+@app.route('/models/<version>/activate', methods=['POST'])
+def activate_model(version):
+    global yolo
+    if not _admin_allowed():
+        return Response(response='[ERROR] Not authorized', status=401)
+    if version not in yolo.registry.versions():
+        return Response(response='[ERROR] Unknown model version : {}'.format(version), status=404)
+    if not yolo.registry.activate_async(version):
+        return Response(response='[ERROR] Another model version is loading', status=409)
+    return Response(response=json.dumps({'loading': version}), status=202, mimetype='application/json')
+
+def init_worker():
+    """Build the model, interpreters, uploader and background threads in
+    this process and start the shared memory transport.  Under gunicorn
+    with preload_app this runs in each worker after the fork, as threads
+    and interpreters cannot be shared with the master."""
+    global yolo, shm_server
+    with _init_lock:
+        if yolo is not None:
+            return
+        yolo = YoloV4TinyModel()
+
+        # Frames can also arrive through a shared memory ring buffer, with only a
+        # small descriptor sent over a Unix socket per frame
+        if os.getenv("SHM_TRANSPORT_SOCKET"):
+            shm_server = ShmFrameServer(os.getenv("SHM_TRANSPORT_SOCKET"),
+                lambda frame, rgb, camera: yolo.Score(frame, rgb, borrowed=True, camera=camera))
+            if not shm_server.start():
+                print({'[WARNING]': 'Shared memory transport socket {} is served by another process'.format(
+                    os.getenv("SHM_TRANSPORT_SOCKET"))})
+
+def preload():
+    """Load what forked workers can share before gunicorn forks them: the
+    TFLite runtime and the model files they will start with"""
+    load_interpreter_class(FLAGS.tflite_backend)
+    paths = [FLAGS.weights]
+    if FLAGS.model_registry:
+        try:
+            with open(os.path.join(FLAGS.model_registry, CURRENT_FILE), 'r') as f:
+                version = f.read().strip()
+            if version:
+                paths.append(os.path.join(FLAGS.model_registry, version, MODEL_FILE))
+        except (IOError, OSError):
+            pass
+    for path in list(paths):
+        stem, ext = os.path.splitext(path)
+        paths += ['{}-{}{}'.format(stem, size, ext) for size in FLAGS.adaptive_sizes]
+    for path in paths:
+        preload_model(path)
+
+# gunicorn.conf.py sets MODEL_PRELOAD when the master imports the app before
+# forking; the workers then call init_worker from post_worker_init
+if os.getenv('MODEL_PRELOAD') == '1':
+    preload()
+    PRELOAD_END = time.time()
+    print({'[INFO]': 'Preloaded the model for workers, memory (MB) of pid {}: {}'.format(
+        os.getpid(), process_memory())})
+else:
+    init_worker()
+
 if __name__ == '__main__':
     # Run the server
     app.run(host='0.0.0.0', port=8888)